@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""A JSON API for entries, under /api/v1
+
+    GET   /api/v1/entries              a page of entries, newest first
+    GET   /api/v1/entries/{id}         one entry
+    POST  /api/v1/entries              create a batch of entries
+    PATCH /api/v1/entries              edit a batch of entries
+
+Reads take `fields`, a comma separated list of the fields to send (by
+default everything but the content), and the listing pages the way the
+HTML one does, by cursor: `before` and `after` come from the `older` and
+`newer` of a previous page, and `limit` says how many entries a page has.
+
+Writes need a logged in user and a JSON body of {"entries": [...]}. A
+batch is applied in the request's transaction, so either every entry in
+it is written or none is. New entries go in with one multi-row INSERT on
+PostgreSQL (a statement per row elsewhere, to get their ids back without
+RETURNING), and edits with one executemany UPDATE. Their Markdown is
+rendered afterwards by render jobs, as for the forms; until it is, reads
+of `content_html` render it on the fly.
+
+Every entry has a version, which goes up by one whenever the entry
+changes. Edits must say which version they were made from; if any entry
+in a batch has moved on since, the whole batch is turned away with
+409 Conflict and the entries' current versions, and the client can fetch
+them again and retry. Each edit's previous and new versions are kept,
+as in the HTML forms, by revisions.py.
+"""
+from __future__ import unicode_literals
+import datetime
+import json
+
+from pyramid.httpexceptions import (
+    HTTPBadRequest, HTTPConflict, HTTPCreated, HTTPForbidden, HTTPNotFound,
+    HTTPUnsupportedMediaType
+)
+import sqlalchemy as sa
+from zope.sqlalchemy import mark_changed
+
+import bulk
+import journal
+import revisions
+
+try:
+    string_types = basestring
+except NameError:  # pragma: no cover
+    string_types = str
+
+
+FIELDS = (
+    'id', 'title', 'date', 'updated_at', 'version', 'content',
+    'content_html',
+)
+DEFAULT_FIELDS = ('id', 'title', 'date', 'updated_at', 'version')
+MAX_LIMIT = 100
+MAX_BATCH = 500
+TITLE_LENGTH = 127
+
+
+def error(exception, message, **details):
+    """An HTTP error with a JSON body, to raise so the transaction aborts"""
+    body = dict(details, error=message)
+    return exception(
+        json_body=body, content_type=str('application/json')
+    )
+
+
+def selected_fields(request):
+    fields = request.params.get('fields')
+    if not fields:
+        return DEFAULT_FIELDS
+    fields = tuple(field.strip() for field in fields.split(','))
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise error(
+            HTTPBadRequest, 'unknown fields', fields=unknown, known=FIELDS)
+    return fields
+
+
+def columns_for(fields):
+    """The columns to load for `fields`, and the cursors' id and date"""
+    names = set(fields) | {'id', 'date'}
+    columns = [
+        getattr(journal.Entry, name) for name in FIELDS if name in names]
+    if 'content_html' in names:
+        # to tell whether the HTML is waiting on its render job
+        Entry = journal.Entry
+        columns.extend([Entry.content_hash, Entry.renderer_version])
+        if 'content' not in names:
+            columns.append(Entry.content)
+    return columns
+
+
+def serialize(row, fields):
+    item = {}
+    for field in fields:
+        value = getattr(row, field)
+        if field == 'content_html' and journal.html_is_stale(row):
+            value = journal.render_markdown(row.content)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        item[field] = value
+    return item
+
+
+def list_entries(request):
+    fields = selected_fields(request)
+    page_size = int(request.registry.settings.get(
+        'journal.page_size', journal.PAGE_SIZE))
+    try:
+        limit = min(int(request.params.get('limit', page_size)), MAX_LIMIT)
+    except ValueError:
+        raise error(HTTPBadRequest, 'invalid limit')
+    if limit < 1:
+        raise error(HTTPBadRequest, 'invalid limit')
+    try:
+        entries, newer, older = journal.Entry.page(
+            before=request.params.get('before'),
+            after=request.params.get('after'),
+            limit=limit, columns=columns_for(fields),
+        )
+    except ValueError:
+        raise error(HTTPBadRequest, 'invalid page cursor')
+    return {
+        'entries': [serialize(entry, fields) for entry in entries],
+        'newer': newer,
+        'older': older,
+    }
+
+
+def get_entry(request):
+    fields = selected_fields(request)
+    entry = journal.DBSession.query(*columns_for(fields)).filter(
+        journal.Entry.id == request.matchdict['id']
+    ).first()
+    if entry is None:
+        raise error(HTTPNotFound, 'no such entry')
+    return serialize(entry, fields)
+
+
+def read_batch(request):
+    """The list of entries in a write request's body, checked over"""
+    if not request.authenticated_userid:
+        raise error(HTTPForbidden, 'log in first')
+    if request.content_type != 'application/json':
+        raise error(HTTPUnsupportedMediaType, 'send application/json')
+    try:
+        body = json.loads(request.body.decode(request.charset or 'utf-8'))
+    except ValueError:
+        raise error(HTTPBadRequest, 'malformed JSON')
+    items = body.get('entries') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        raise error(HTTPBadRequest, 'expected {"entries": [...]}')
+    if len(items) > MAX_BATCH:
+        raise error(
+            HTTPBadRequest, 'at most {} entries at a time'.format(MAX_BATCH))
+    return items
+
+
+def check_text(item, field, required):
+    value = item.get(field)
+    if value is None and not required:
+        return None
+    if not isinstance(value, string_types) or not value.strip():
+        return '{} must be a non-empty string'.format(field)
+    if field == 'title' and len(value) > TITLE_LENGTH:
+        return 'title must be at most {} characters'.format(TITLE_LENGTH)
+    return None
+
+
+def check_items(items, check):
+    """Raise a 400 listing every item `check` finds fault with"""
+    errors = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            problem = 'expected an object'
+        else:
+            problem = check(item)
+        if problem:
+            errors.append({'index': index, 'error': problem})
+    if errors:
+        raise error(HTTPBadRequest, 'invalid entries', entries=errors)
+
+
+def check_new(item):
+    problem = check_text(item, 'title', True) or \
+        check_text(item, 'content', True)
+    if problem:
+        return problem
+    if item.get('date') is not None:
+        try:
+            bulk.parse_date(item['date'])
+        except (ValueError, AttributeError):
+            return 'date must be an ISO 8601 date'
+    return None
+
+
+def check_edit(item):
+    for field in ('id', 'version'):
+        if not isinstance(item.get(field), int) or \
+                isinstance(item[field], bool):
+            return '{} must be an integer'.format(field)
+    return check_text(item, 'title', False) or \
+        check_text(item, 'content', False)
+
+
+def insert_entries(session, rows):
+    """Insert rows; returns [(id, version)] in the same order"""
+    table = journal.Entry.__table__
+    if session.connection().dialect.name == 'postgresql':
+        result = session.execute(
+            table.insert().values(rows).returning(table.c.id, table.c.version)
+        )
+        return [tuple(row) for row in result]
+    # no RETURNING: one statement per row, for its id
+    created = []
+    for row in rows:
+        result = session.execute(table.insert(), row)
+        created.append((result.inserted_primary_key[0], 1))
+    return created
+
+
+def create_entries(request):
+    items = read_batch(request)
+    check_items(items, check_new)
+    now = datetime.datetime.utcnow()
+    rows = [
+        dict(bulk.to_row(item, now, render=False), version=1)
+        for item in items
+    ]
+    session = journal.DBSession
+    session.flush()
+    created = insert_entries(session, rows)
+    for entry_id, version in created:
+        journal.queue_render(session, entry_id, version)
+    # written past the ORM, so pyramid_tm has to be told to commit
+    mark_changed(session())
+    request.registry.notify(journal.EntriesChanged(
+        request, [entry_id for entry_id, version in created], created=True
+    ))
+    return HTTPCreated(
+        json_body={'entries': [
+            {'id': entry_id, 'version': version}
+            for entry_id, version in created
+        ]},
+        content_type=str('application/json')
+    )
+
+
+def update_entries(request):
+    items = read_batch(request)
+    check_items(items, check_edit)
+    expected = dict((item['id'], item['version']) for item in items)
+    if len(expected) != len(items):
+        raise error(HTTPBadRequest, 'an entry appears more than once')
+    Entry = journal.Entry
+    session = journal.DBSession
+    session.flush()
+    # lock the rows, so nothing can change them between the version check
+    # and the UPDATE
+    current = dict(
+        (row.id, row) for row in session.query(
+            Entry.id, Entry.version, Entry.title, Entry.content,
+            Entry.content_html, Entry.content_hash, Entry.renderer_version
+        ).filter(Entry.id.in_(list(expected))).with_for_update()
+    )
+    conflicts = [
+        {'id': entry_id,
+         'version': current[entry_id].version if entry_id in current
+         else None}
+        for entry_id in sorted(expected)
+        if entry_id not in current or
+        current[entry_id].version != expected[entry_id]
+    ]
+    if conflicts:
+        raise error(
+            HTTPConflict, 'entries have changed or are gone',
+            entries=conflicts
+        )
+
+    now = datetime.datetime.utcnow()
+    rows = []
+    changes = []
+    stale = []
+    for item in items:
+        row = current[item['id']]
+        content = item.get('content') or row.content
+        hashed = journal.content_hash(content)
+        if (
+            row.content_html is None or row.content_hash != hashed or
+            row.renderer_version != journal.RENDERER_VERSION
+        ):
+            # the stored HTML is the old content's now, as after
+            # Entry.edit(render=False); a render job replaces it
+            hashed = None
+            stale.append((row.id, row.version + 1))
+        rows.append({
+            'match_id': row.id,
+            'match_version': row.version,
+            'title': item.get('title') or row.title,
+            'content': content,
+            'content_hash': hashed,
+            'updated_at': now,
+            'version': row.version + 1,
+        })
+        changes.append(revisions.Change(
+            row.id, row.version + 1, row.title, row.content,
+            rows[-1]['title'], content
+        ))
+    table = Entry.__table__
+    statement = table.update().where(sa.and_(
+        table.c.id == sa.bindparam('match_id'),
+        table.c.version == sa.bindparam('match_version'),
+    ))
+    result = session.execute(statement, rows)
+    if result.supports_sane_multi_rowcount() and \
+            result.rowcount != len(rows):
+        raise error(HTTPConflict, 'entries changed during the update')
+    revisions.record(session, changes, now)
+    for entry_id, version in stale:
+        journal.queue_render(session, entry_id, version)
+    mark_changed(session())
+    # entries already loaded in this session are out of date now
+    session.expire_all()
+    request.registry.notify(journal.EntriesChanged(request, list(expected)))
+    return {'entries': [
+        {'id': row['match_id'], 'version': row['version']} for row in rows
+    ]}
+
+
+def includeme(config):
+    config.add_route('api_entries', '/api/v1/entries')
+    config.add_route('api_entry', r'/api/v1/entries/{id:\d+}')
+    config.add_view(
+        list_entries, route_name='api_entries', request_method='GET',
+        renderer='json'
+    )
+    config.add_view(
+        create_entries, route_name='api_entries', request_method='POST')
+    config.add_view(
+        update_entries, route_name='api_entries', request_method='PATCH',
+        renderer='json'
+    )
+    config.add_view(
+        get_entry, route_name='api_entry', request_method='GET',
+        renderer='json'
+    )
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Browsing entries by year and month
+
+Archive pages are range queries on `entries.date`, which the listing's
+(date, id) index serves, paged by cursor like the home page.
+
+The archive sidebar's per-month counts come from the `entry_months`
+summary table rather than a GROUP BY over every entry. Triggers keep it
+up to date as entries are inserted, deleted or moved to another date,
+on PostgreSQL and SQLite alike, so bulk loads that bypass the ORM are
+counted too, and the sidebar costs one row per month however many
+entries there are. So does the number of entries, for listing ETags.
+"""
+from __future__ import unicode_literals
+import calendar
+import datetime
+from collections import namedtuple
+
+import sqlalchemy as sa
+
+
+# the year and month of a date, as integers
+PARTS = {
+    'postgresql': (
+        'CAST(EXTRACT(YEAR FROM {0}.date) AS INTEGER)',
+        'CAST(EXTRACT(MONTH FROM {0}.date) AS INTEGER)',
+    ),
+    'sqlite': (
+        "CAST(strftime('%Y', {0}.date) AS INTEGER)",
+        "CAST(strftime('%m', {0}.date) AS INTEGER)",
+    ),
+}
+
+
+def _count(dialect, row, change):
+    year, month = (part.format(row) for part in PARTS[dialect])
+    if dialect == 'postgresql':
+        return (
+            'INSERT INTO entry_months (year, month, count) '
+            'VALUES ({0}, {1}, {2}) ON CONFLICT (year, month) '
+            'DO UPDATE SET count = entry_months.count + {2};'
+        ).format(year, month, change)
+    return (
+        'INSERT OR IGNORE INTO entry_months (year, month, count) '
+        'VALUES ({0}, {1}, 0); '
+        'UPDATE entry_months SET count = count + {2} '
+        'WHERE year = {0} AND month = {1};'
+    ).format(year, month, change)
+
+
+INSTALL = {
+    'postgresql': [
+        'CREATE OR REPLACE FUNCTION entry_months_update() '
+        'RETURNS trigger AS $$ BEGIN '
+        "IF TG_OP IN ('DELETE', 'UPDATE') THEN " +
+        _count('postgresql', 'OLD', -1) + ' END IF; '
+        "IF TG_OP IN ('INSERT', 'UPDATE') THEN " +
+        _count('postgresql', 'NEW', 1) + ' END IF; '
+        'RETURN NULL; END $$ LANGUAGE plpgsql',
+        'DROP TRIGGER IF EXISTS entry_months_update ON entries',
+        'CREATE TRIGGER entry_months_update '
+        'AFTER INSERT OR DELETE OR UPDATE OF date ON entries '
+        'FOR EACH ROW EXECUTE PROCEDURE entry_months_update()',
+    ],
+    'sqlite': [
+        'CREATE TRIGGER IF NOT EXISTS entry_months_insert '
+        'AFTER INSERT ON entries BEGIN ' +
+        _count('sqlite', 'new', 1) + ' END',
+        'CREATE TRIGGER IF NOT EXISTS entry_months_delete '
+        'AFTER DELETE ON entries BEGIN ' +
+        _count('sqlite', 'old', -1) + ' END',
+        'CREATE TRIGGER IF NOT EXISTS entry_months_update '
+        'AFTER UPDATE OF date ON entries BEGIN ' +
+        _count('sqlite', 'old', -1) + ' ' + _count('sqlite', 'new', 1) +
+        ' END',
+    ],
+}
+
+
+def rebuild_statements(dialect):
+    year, month = (part.format('entries') for part in PARTS[dialect])
+    return [
+        'DELETE FROM entry_months',
+        'INSERT INTO entry_months (year, month, count) '
+        'SELECT {0}, {1}, COUNT(*) FROM entries '
+        'GROUP BY {0}, {1}'.format(year, month),
+    ]
+
+
+class Month(namedtuple('Month', 'year month count')):
+    @property
+    def name(self):
+        return calendar.month_name[self.month]
+
+
+def execute_all(conn, statements):
+    for statement in statements:
+        conn.execute(sa.text(statement))
+
+
+def install(conn):
+    """Set up the triggers, then count the entries already there"""
+    execute_all(conn, INSTALL.get(conn.dialect.name, []))
+    rebuild(conn)
+
+
+def rebuild(conn):
+    """Count every month again from scratch"""
+    execute_all(conn, rebuild_statements(conn.dialect.name))
+
+
+def on_create(target, conn, **kw):
+    execute_all(conn, INSTALL.get(conn.dialect.name, []))
+
+
+def listen(table):
+    """Have create_all set up the triggers on the entries table"""
+    sa.event.listen(table, 'after_create', on_create)
+
+
+def months(session):
+    """Every month with entries in it, newest first, as Months"""
+    rows = session.execute(sa.text(
+        'SELECT year, month, count FROM entry_months WHERE count > 0 '
+        'ORDER BY year DESC, month DESC'
+    ))
+    return [Month(*row) for row in rows]
+
+
+def total(session):
+    """The number of entries, added up from the months"""
+    return session.execute(sa.text(
+        'SELECT coalesce(sum(count), 0) FROM entry_months'
+    )).scalar()
+
+
+def date_range(year, month=None):
+    """The [start, end) datetimes of a year, or of a month in it
+
+    Raises ValueError for a year or month that can't be shown.
+    """
+    if month is None:
+        return datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
+    start = datetime.datetime(year, month, 1)
+    if month == 12:
+        return start, datetime.datetime(year + 1, 1, 1)
+    return start, datetime.datetime(year, month + 1, 1)
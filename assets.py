@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Fingerprinted static assets
+
+Every file under static/ is copied into the build directory under a name
+that includes a hash of its contents (main.css becomes
+main.3f2a9c1b04d7.css), next to gzip and, if the brotli module is
+installed, brotli compressed copies. A manifest maps the plain names to
+the hashed ones. Templates link assets through `asset_url('main.css')`.
+
+Because a hashed name only ever has one content, /assets/ responses are
+cacheable for a year and marked immutable, so browsers don't even
+revalidate them. A change to a file gives it a new name, and so a new URL.
+The files of the build before the current one are still served, for the
+pages browsers and caches already hold, which link to them; and pages'
+ETags include the manifest's `digest`, so revalidating one after a
+deploy gets the page with the new links.
+
+The build runs on startup, writing only what is missing, and can be run
+ahead of time with `python manage.py assets`.
+"""
+from __future__ import unicode_literals
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+
+import jinja2
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import FileResponse
+from pyramid_jinja2 import EXTRAS_CONFIG_PHASE
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always built
+    brotli = None
+
+
+MANIFEST = 'manifest.json'
+# the hashed names of the build before, still served
+PREVIOUS = 'previous.json'
+MAX_AGE = 365 * 24 * 60 * 60
+CACHE_CONTROL = 'public, max-age={}, immutable'.format(MAX_AGE)
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                'image/svg+xml')
+# Content-Encoding, file suffix, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with io.open(path, 'rb') as source:
+        for block in iter(lambda: source.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def hashed_name(name, digest):
+    root, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(root, digest, ext)
+
+
+def is_compressible(name):
+    content_type = mimetypes.guess_type(name, strict=False)[0] or ''
+    return content_type.startswith(COMPRESSIBLE)
+
+
+def write_atomic(path, data):
+    with io.open(path + '.tmp', 'wb') as out:
+        out.write(data)
+    os.rename(path + '.tmp', path)
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    # a fixed mtime keeps the output, and so the build, reproducible
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9,
+                       mtime=0) as out:
+        out.write(data)
+    return buf.getvalue()
+
+
+def compress(path):
+    """Write the compressed copies of `path` that come out smaller"""
+    with io.open(path, 'rb') as source:
+        data = source.read()
+    variants = [('.gz', gzip_bytes)]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress))
+    for suffix, squeeze in variants:
+        if os.path.exists(path + suffix):
+            continue
+        packed = squeeze(data)
+        if len(packed) < len(data):
+            write_atomic(path + suffix, packed)
+
+
+def source_files(source):
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(root, filename)
+            yield os.path.relpath(path, source).replace(os.sep, '/'), path
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with io.open(path, 'rb') as source:
+        return json.loads(source.read().decode('utf-8'))
+
+
+def build(source, target, generated=None):
+    """Fingerprint and compress everything in `source` into `target`
+
+    `generated` maps more plain names to the bytes of files made by the
+    app itself, which are built alongside, so nothing is written to
+    `source`. Returns the manifest, {plain name: hashed name}.
+    """
+    before = load_json(os.path.join(target, MANIFEST), None)
+    manifest = {}
+    for name, data in sorted((generated or {}).items()):
+        hashed = hashed_name(
+            name, hashlib.sha1(data).hexdigest()[:12])
+        out = os.path.join(target, *hashed.split('/'))
+        if not os.path.exists(out):
+            if not os.path.isdir(os.path.dirname(out)):
+                os.makedirs(os.path.dirname(out))
+            write_atomic(out, data)
+        if is_compressible(name):
+            compress(out)
+        manifest[name] = hashed
+    for name, path in source_files(source):
+        hashed = hashed_name(name, file_hash(path))
+        out = os.path.join(target, *hashed.split('/'))
+        if not os.path.exists(out):
+            if not os.path.isdir(os.path.dirname(out)):
+                os.makedirs(os.path.dirname(out))
+            shutil.copyfile(path, out + '.tmp')
+            os.rename(out + '.tmp', out)
+        if is_compressible(name):
+            compress(out)
+        manifest[name] = hashed
+    if before is not None and before != manifest:
+        write_atomic(os.path.join(target, PREVIOUS), json.dumps(sorted(
+            set(before.values()) - set(manifest.values())
+        ), indent=2).encode('utf-8'))
+    write_atomic(
+        os.path.join(target, MANIFEST),
+        json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+    )
+    return manifest
+
+
+class Assets(object):
+    """The built assets, and how to link to and serve them"""
+
+    def __init__(self, target, manifest, previous=()):
+        self.target = target
+        self.manifest = manifest
+        self.hashed = set(manifest.values()) | set(previous)
+        self.digest = hashlib.sha1(json.dumps(
+            manifest, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    def path(self, hashed):
+        return os.path.join(self.target, *hashed.split('/'))
+
+    def url(self, request, name):
+        return request.route_path('asset', name=self.manifest[name])
+
+    def response(self, request, hashed):
+        """Serve a hashed file, precompressed if the client takes that"""
+        if hashed not in self.hashed:
+            raise HTTPNotFound()
+        path = self.path(hashed)
+        content_type = str(
+            mimetypes.guess_type(hashed, strict=False)[0] or
+            'application/octet-stream'
+        )
+        encoding = None
+        for name, suffix in ENCODINGS:
+            if request.accept_encoding.quality(name) and \
+                    os.path.exists(path + suffix):
+                encoding = name
+                path += suffix
+                break
+        response = FileResponse(
+            path, request, content_type=content_type,
+            content_encoding=str(encoding) if encoding else None
+        )
+        response.headers[str('Cache-Control')] = str(CACHE_CONTROL)
+        response.etag = '{}{}'.format(
+            hashed, '-' + encoding if encoding else '')
+        if is_compressible(hashed):
+            response.vary = (str('Accept-Encoding'),)
+        return response
+
+
+def asset_view(request):
+    return request.registry.assets.response(
+        request, request.matchdict['name'])
+
+
+@jinja2.contextfunction
+def asset_url(context, name):
+    """The fingerprinted URL of a file in static/"""
+    request = context['request']
+    return request.registry.assets.url(request, name)
+
+
+def includeme(config):
+    settings = config.get_settings()
+    target = settings['assets.build_dir']
+    manifest = build(settings['assets.source_dir'], target,
+                     settings.get('assets.generated'))
+    config.registry.assets = Assets(
+        target, manifest, load_json(os.path.join(target, PREVIOUS), []))
+    config.add_route('asset', '/assets/{name:.+}')
+    config.add_view(asset_view, route_name='asset')
+
+    def add_global():
+        config.get_jinja2_environment().globals['asset_url'] = asset_url
+    config.action(None, add_global, order=EXTRAS_CONFIG_PHASE)
@@ -0,0 +1,635 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the learning journal
+
+    python bench.py routes --entries 5000 --clients 8
+
+seeds a database (a throwaway SQLite file unless --database-url is given)
+with realistic entries, drives the WSGI app in-process from concurrent
+client threads and reports throughput and p50/p95/p99 latency per route.
+
+Every run is appended, with the git commit it ran against, to
+bench_results.jsonl, and compared with the last run of the same benchmark
+and parameters, so regressions between commits show up.
+"""
+from __future__ import unicode_literals, print_function
+import argparse
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(HERE, 'bench_results.jsonl')
+
+# the slowest a search results page may be at p95, for 100k entries. The
+# seeded entries share one small vocabulary, so every search matches
+# nearly all of them and has to rank the lot: real searches do far less
+SEARCH_BUDGET_MS = 300
+
+WORDS = (
+    'python list dict generator decorator class instance closure scope '
+    'query index session transaction template request response view route '
+    'test fixture assert module package import string bytes unicode tuple '
+    'iterate yield lambda map filter reduce sort key value cache thread'
+).split()
+
+
+def sentence(rand, words=12):
+    text = ' '.join(rand.choice(WORDS) for _ in range(words))
+    return text.capitalize() + '.'
+
+
+def code_block(rand, lines=8):
+    body = ['    :::python', '    def {}({}):'.format(
+        rand.choice(WORDS), ', '.join(rand.sample(WORDS, 2)))]
+    for _ in range(lines):
+        body.append('        {} = {}({!r}, {})'.format(
+            rand.choice(WORDS), rand.choice(WORDS), rand.choice(WORDS),
+            rand.randint(0, 100)))
+    body.append('        return {}'.format(rand.choice(WORDS)))
+    return '\n'.join(body)
+
+
+def make_entry(rand, paragraphs=6, code_blocks=2):
+    """Markdown shaped like a real journal entry: prose, lists and code"""
+    parts = ['### ' + sentence(rand, 4)]
+    for x in range(paragraphs):
+        parts.append(' '.join(sentence(rand) for _ in range(4)))
+        if x % 3 == 1:
+            parts.append('\n'.join(
+                '* ' + sentence(rand, 6) for _ in range(3)))
+        if x < code_blocks:
+            parts.append(code_block(rand))
+    return {
+        'title': sentence(rand, 5)[:120],
+        'content': '\n\n'.join(parts),
+    }
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    index = max(int(round(fraction * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def summarise(latencies, wall, statuses):
+    ordered = sorted(latencies)
+
+    def ms(seconds):
+        return round(seconds * 1000, 3) if seconds is not None else None
+
+    return {
+        'requests': len(ordered),
+        'throughput': round(len(ordered) / wall, 1) if wall else None,
+        'p50_ms': ms(percentile(ordered, 0.50)),
+        'p95_ms': ms(percentile(ordered, 0.95)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'statuses': statuses,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=subprocess.STDOUT
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous(name, params):
+    """The last saved run of the same benchmark with the same parameters"""
+    last = None
+    if os.path.exists(RESULTS):
+        with io.open(RESULTS, encoding='utf-8') as lines:
+            for line in lines:
+                run = json.loads(line)
+                if run['benchmark'] == name and run['params'] == params:
+                    last = run
+    return last
+
+
+def record(name, params, results):
+    """Save a run to bench_results.jsonl and print it next to the last one"""
+    before = previous(name, params)
+    run = {
+        'benchmark': name,
+        'commit': git_commit(),
+        'when': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': params,
+        'results': results,
+    }
+    with io.open(RESULTS, 'a', encoding='utf-8') as out:
+        out.write('{}\n'.format(json.dumps(run, sort_keys=True)))
+    report(run, before)
+    return run
+
+
+def report(run, before=None):
+    print('{} @ {}  {}'.format(
+        run['benchmark'], run['commit'],
+        json.dumps(run['params'], sort_keys=True)))
+    if before is not None:
+        print('  (compared with {} @ {})'.format(
+            before['when'], before['commit']))
+    for name, result in sorted(run['results'].items()):
+        cells = []
+        for key, value in sorted(result.items()):
+            if not isinstance(value, (int, float)):
+                continue
+            cell = '{}={}'.format(key, value)
+            old = (before or {}).get('results', {}).get(name, {}).get(key)
+            if isinstance(old, (int, float)) and old:
+                cell += ' ({:+.0%})'.format((value - old) / float(old))
+            cells.append(cell)
+        print('  {:<10} {}'.format(name, '  '.join(cells)))
+        statuses = result.get('statuses')
+        if statuses:
+            print('  {:<10} statuses {}'.format('', statuses))
+
+
+def use_database(url):
+    """Point the app at the benchmark database; must run before importing it"""
+    if url is None:
+        url = 'sqlite:///' + os.path.join(tempfile.gettempdir(),
+                                          'journal-bench.db')
+    os.environ['DATABASE_URL'] = url
+    os.environ.pop('TESTING', None)
+    return url
+
+
+def seed(count, seed_value=0):
+    """Make sure the benchmark database has at least `count` entries"""
+    import journal
+    import bulk
+    journal.init_db()
+    with journal.engine.connect() as conn:
+        have = conn.execute(
+            journal.sa.select([journal.sa.func.count(journal.Entry.id)])
+        ).scalar()
+    rand = random.Random(seed_value + have)
+    now = datetime.datetime.utcnow()
+    while have < count:
+        batch = min(bulk.BATCH_SIZE, count - have)
+        rows = []
+        for x in range(batch):
+            entry = make_entry(rand)
+            entry['date'] = (now - datetime.timedelta(
+                hours=count - have - x)).strftime(bulk.DATE_FORMATS[0])
+            rows.append(bulk.to_row(entry, now))
+        with journal.engine.begin() as conn:
+            bulk.insert_rows(conn, rows)
+        have += batch
+    with journal.engine.connect() as conn:
+        return [row[0] for row in conn.execute(
+            journal.sa.select([journal.Entry.id]))]
+
+
+def drive(app, make_request, total, clients):
+    """Send `total` requests from `clients` threads; return a summary"""
+    from webob import Request
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    remaining = [total]
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            request = Request.blank(**make_request())
+            start = time.time()
+            response = request.get_response(app)
+            response.body
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                key = '{}'.format(response.status_int)
+                statuses[key] = statuses.get(key, 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarise(latencies, time.time() - start, statuses)
+
+
+def login_cookie(app, username='admin', password='secret'):
+    from webob import Request
+    request = Request.blank('/login', POST={
+        'username': username, 'password': password})
+    response = request.get_response(app)
+    # WSGI wants a native string here, whatever the Python version
+    return str(response.headers['Set-Cookie'].split(';', 1)[0])
+
+
+def bench_routes(args):
+    """Throughput and latency of the main routes against a seeded database"""
+    use_database(args.database_url)
+    os.environ['PAGE_CACHE'] = args.page_cache
+    os.environ.setdefault('LOGIN_PER_CLIENT', '1000')
+    os.environ.setdefault('LOGIN_QUEUE', '1000')
+    ids = seed(args.entries)
+    import journal
+    app = journal.main()
+    cookie = login_cookie(app)
+    rand = random.Random(1)
+    routes = {
+        'list': lambda: {'path': '/'},
+        'detail': lambda: {
+            'path': '/detail?id={}'.format(rand.choice(ids))},
+        'search': lambda: {
+            'path': '/search?q={}'.format(rand.choice(WORDS))},
+        'login': lambda: {
+            'path': '/login',
+            'POST': {'username': 'admin', 'password': 'secret'}},
+        'commit': lambda: dict(
+            path='/commit', headers={'Cookie': cookie},
+            POST=dict(id='{}'.format(rand.choice(ids)),
+                      **make_entry(rand))),
+    }
+    wanted = args.routes.split(',') if args.routes else sorted(routes)
+    results = {}
+    for name in wanted:
+        total = args.requests if name != 'login' else args.login_requests
+        drive(app, routes[name], min(total, args.clients * 2), args.clients)
+        results[name] = drive(app, routes[name], total, args.clients)
+    params = {
+        'entries': args.entries, 'clients': args.clients,
+        'requests': args.requests, 'page_cache': args.page_cache,
+        'database': journal.engine.url.drivername,
+    }
+    record('routes', params, results)
+
+
+def gzipped_size(text):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+        out.write(text.encode('utf-8'))
+    return len(buf.getvalue())
+
+
+def bench_highlight(args):
+    """Detail page bytes with inline and with class based highlighting"""
+    use_database(None)
+    import highlight
+    import journal
+    rand = random.Random(0)
+    entries = [
+        make_entry(rand, code_blocks=args.code_blocks)['content']
+        for _ in range(args.entries)
+    ]
+    results = {}
+    for mode in highlight.MODES:
+        start = time.time()
+        pages = [journal.render_markdown(text, mode) for text in entries]
+        elapsed = time.time() - start
+        results[mode] = {
+            'html_bytes': sum(len(page.encode('utf-8')) for page in pages) //
+            len(pages),
+            'gzip_bytes': sum(gzipped_size(page) for page in pages) //
+            len(pages),
+            'render_ms': round(elapsed * 1000 / len(pages), 3),
+        }
+    css = highlight.stylesheet()
+    results['stylesheet'] = {
+        'css_bytes': len(css.encode('utf-8')), 'gzip_bytes': gzipped_size(css)
+    }
+    params = {'entries': args.entries, 'code_blocks': args.code_blocks}
+    record('highlight', params, results)
+
+
+def time_calls(func, texts, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for text in texts:
+            func(text)
+    return (time.time() - start) / (repeat * len(texts))
+
+
+def bench_renderer(args):
+    """Markdown rendering: a fresh pipeline per call against a reused one"""
+    use_database(None)
+    import markdown
+    from markdown.extensions import codehilite
+    import highlight
+    import renderer
+    rand = random.Random(0)
+    sizes = {
+        'short': [
+            make_entry(rand, paragraphs=1, code_blocks=0)['content']
+            for _ in range(args.entries)
+        ],
+        'long': [
+            make_entry(rand, paragraphs=12, code_blocks=6)['content']
+            for _ in range(args.entries)
+        ],
+    }
+    config = highlight.markdown_config(args.mode)
+
+    def fresh(text):
+        return markdown.markdown(
+            text, extensions=renderer.EXTENSIONS, extension_configs=config)
+
+    def reused(text):
+        return renderer.render(text, args.mode)
+
+    results = {}
+    for size, texts in sorted(sizes.items()):
+        # warm both up, so imports and the lexer cache don't count
+        fresh(texts[0])
+        reused(texts[0])
+        # the baseline is the old way all round: no lexer cache either
+        codehilite.get_lexer_by_name = renderer.find_lexer
+        try:
+            before = time_calls(fresh, texts, args.repeat)
+        finally:
+            codehilite.get_lexer_by_name = renderer.get_lexer_by_name
+        after = time_calls(reused, texts, args.repeat)
+        results[size] = {
+            'fresh_ms': round(before * 1000, 3),
+            'reused_ms': round(after * 1000, 3),
+            'speedup': round(before / after, 2),
+        }
+    params = {'entries': args.entries, 'repeat': args.repeat,
+              'mode': args.mode}
+    record('renderer', params, results)
+
+
+def startup_child(args):
+    """Runs in a fresh interpreter: time import, app setup and first hits"""
+    timings = {}
+    start = time.time()
+    import journal
+    timings['import_ms'] = time.time() - start
+    mark = time.time()
+    app = journal.main()
+    timings['main_ms'] = time.time() - mark
+    from webob import Request
+    for name, path in (('first_list_ms', '/'),
+                       ('first_detail_ms', '/detail?id={}'.format(args.id))):
+        mark = time.time()
+        response = Request.blank(path).get_response(app)
+        response.body
+        timings[name] = time.time() - mark
+        assert response.status_int == 200, (path, response.status)
+    timings['ready_ms'] = time.time() - start
+    print(json.dumps(dict(
+        (name, round(seconds * 1000, 1)) for name, seconds in timings.items()
+    )))
+
+
+def bench_startup(args):
+    """Import, app setup and first request times of a fresh process"""
+    if args.child:
+        return startup_child(args)
+    use_database(args.database_url)
+    ids = seed(args.entries)
+    import journal
+    env = dict(os.environ, PAGE_CACHE='off')
+    # run as scripts, not with -c, so template paths (and so the bytecode
+    # cache keys) are the same as when the app is deployed
+    script = os.path.join(HERE, 'bench.py')
+    results = {}
+    for cache in ('cold', 'warm'):
+        runs = []
+        for _ in range(args.runs):
+            env['TEMPLATE_CACHE_DIR'] = tempfile.mkdtemp(prefix='journal-')
+            if cache == 'warm':
+                subprocess.check_output(
+                    [sys.executable, os.path.join(HERE, 'manage.py'),
+                     'templates'], env=env, cwd=HERE)
+            start = time.time()
+            output = subprocess.check_output(
+                [sys.executable, script, 'startup', '--child',
+                 '--id', '{}'.format(ids[0])], env=env, cwd=HERE)
+            run = json.loads(output.decode('utf-8').splitlines()[-1])
+            run['process_ms'] = round((time.time() - start) * 1000, 1)
+            runs.append(run)
+        results[cache] = dict(
+            (name, sorted(run[name] for run in runs)[len(runs) // 2])
+            for name in runs[0]
+        )
+    params = {'entries': args.entries, 'runs': args.runs,
+              'database': journal.engine.url.drivername}
+    record('startup', params, results)
+    took = results['warm']['process_ms']
+    if args.budget_ms and took > args.budget_ms:
+        print('over budget: a warm start took {}ms, the budget is {}ms'.format(
+            took, args.budget_ms))
+        return 1
+    return 0
+
+
+def edit_entry(rand, text):
+    """Text as after one more edit: a few lines changed, added or cut"""
+    lines = text.split('\n')
+    for _ in range(rand.randint(1, 3)):
+        at = rand.randrange(len(lines))
+        action = rand.random()
+        if action < 0.6:
+            words = lines[at].split(' ')
+            words[rand.randrange(len(words))] = rand.choice(WORDS)
+            lines[at] = ' '.join(words)
+        elif action < 0.85 or len(lines) < 10:
+            lines.insert(at, sentence(rand))
+        else:
+            del lines[at]
+    return '\n'.join(lines)
+
+
+def bench_revisions(args):
+    """Revision storage size and the time to rebuild versions"""
+    use_database(args.database_url)
+    import journal
+    import revisions
+    journal.init_db()
+    journal.DBSession.configure(bind=journal.engine)
+    session = journal.DBSession()
+    rand = random.Random(0)
+    texts = [make_entry(rand, paragraphs=args.paragraphs)['content']]
+    for _ in range(args.edits):
+        texts.append(edit_entry(rand, texts[-1]))
+    entry = journal.Entry(title='Revisions', content=texts[0], version=1)
+    session.add(entry)
+    session.flush()
+    start = time.time()
+    for number, text in enumerate(texts[1:], 2):
+        revisions.record(session, [revisions.Change(
+            entry.id, number, entry.title, texts[number - 2], entry.title,
+            text)])
+    record_ms = (time.time() - start) * 1000 / args.edits
+
+    stored = sum(revision.size for revision in
+                 revisions.history(session, entry.id))
+    full = sum(len(text.encode('utf-8')) for text in texts)
+    compressed = sum(len(revisions.pack_text(text)) for text in texts)
+    latencies = []
+    for number in range(1, len(texts) + 1):
+        mark = time.time()
+        text = revisions.content(session, entry.id, number)
+        latencies.append(time.time() - mark)
+        assert text == texts[number - 1], number
+    session.rollback()
+    latencies.sort()
+    results = {
+        'storage': {
+            'stored_bytes': stored,
+            'full_bytes': full,
+            'zlib_bytes': compressed,
+            'vs_full': round(stored / float(full), 3),
+            'vs_zlib': round(stored / float(compressed), 3),
+        },
+        'rebuild': {
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'record_ms': round(record_ms, 3),
+        },
+    }
+    params = {'edits': args.edits, 'paragraphs': args.paragraphs,
+              'snapshot_every': revisions.SNAPSHOT_EVERY,
+              'database': journal.engine.url.drivername}
+    record('revisions', params, results)
+
+
+def bench_search(args):
+    """Search latency per results page against a seeded database"""
+    use_database(args.database_url)
+    seed(args.entries)
+    import journal
+    import search
+    journal.DBSession.configure(bind=journal.engine)
+    session = journal.DBSession()
+    rand = random.Random(0)
+    queries = {
+        'one_word': lambda: rand.choice(WORDS),
+        'two_words': lambda: ' '.join(rand.sample(WORDS, 2)),
+    }
+    results = {}
+    for name, make_query in sorted(queries.items()):
+        first, deep = [], []
+        for _ in range(args.queries):
+            query = make_query()
+            after = None
+            for number in range(args.pages):
+                start = time.time()
+                hits, better, after = search.page(
+                    session, query, limit=args.page_size, after=after)
+                (first if number == 0 else deep).append(time.time() - start)
+                if after is None:
+                    break
+        for label, latencies in (('first_page', first), ('deep_page', deep)):
+            latencies.sort()
+            results['{}_{}'.format(name, label)] = {
+                'requests': len(latencies),
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+            }
+    session.close()
+    params = {'entries': args.entries, 'queries': args.queries,
+              'pages': args.pages, 'page_size': args.page_size,
+              'database': journal.engine.url.drivername}
+    record('search', params, results)
+    over = [
+        (name, result['p95_ms']) for name, result in sorted(results.items())
+        if args.budget_ms and result['p95_ms'] > args.budget_ms
+    ]
+    for name, took in over:
+        print('over budget: {} p95 took {}ms, the budget is {}ms'.format(
+            name, took, args.budget_ms))
+    return 1 if over else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    benchmarks = parser.add_subparsers(dest='benchmark')
+
+    cmd = benchmarks.add_parser('routes', help=bench_routes.__doc__.lower())
+    cmd.add_argument('--database-url',
+                     help='defaults to a SQLite file in the temp directory')
+    cmd.add_argument('--entries', type=int, default=1000)
+    cmd.add_argument('--clients', type=int, default=4)
+    cmd.add_argument('--requests', type=int, default=500,
+                     help='requests per route')
+    cmd.add_argument('--login-requests', type=int, default=50,
+                     help='requests for the (deliberately slow) login route')
+    cmd.add_argument('--routes', help='comma separated subset of routes')
+    cmd.add_argument('--page-cache', default='off',
+                     help='PAGE_CACHE setting for the run (default off)')
+    cmd.set_defaults(func=bench_routes)
+
+    cmd = benchmarks.add_parser('highlight',
+                                help=bench_highlight.__doc__.lower())
+    cmd.add_argument('--entries', type=int, default=200)
+    cmd.add_argument('--code-blocks', type=int, default=2,
+                     help='code blocks per entry')
+    cmd.set_defaults(func=bench_highlight)
+
+    cmd = benchmarks.add_parser('renderer',
+                                help=bench_renderer.__doc__.lower())
+    cmd.add_argument('--entries', type=int, default=50)
+    cmd.add_argument('--repeat', type=int, default=5)
+    cmd.add_argument('--mode', default='inline',
+                     help='highlighting mode (inline or classes)')
+    cmd.set_defaults(func=bench_renderer)
+
+    cmd = benchmarks.add_parser('startup', help=bench_startup.__doc__.lower())
+    cmd.add_argument('--database-url',
+                     help='defaults to a SQLite file in the temp directory')
+    cmd.add_argument('--entries', type=int, default=100)
+    cmd.add_argument('--runs', type=int, default=5,
+                     help='fresh processes per case; the median is reported')
+    cmd.add_argument('--budget-ms', type=float, default=1500,
+                     help='fail if a warm start takes longer (0 to disable)')
+    cmd.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    cmd.add_argument('--id', type=int, help=argparse.SUPPRESS)
+    cmd.set_defaults(func=bench_startup)
+
+    cmd = benchmarks.add_parser('revisions',
+                                help=bench_revisions.__doc__.lower())
+    cmd.add_argument('--database-url',
+                     help='defaults to a SQLite file in the temp directory')
+    cmd.add_argument('--edits', type=int, default=500,
+                     help='edits made to the one entry')
+    cmd.add_argument('--paragraphs', type=int, default=20,
+                     help='paragraphs in the entry, so how big it is')
+    cmd.set_defaults(func=bench_revisions)
+
+    cmd = benchmarks.add_parser('search', help=bench_search.__doc__.lower())
+    cmd.add_argument('--database-url',
+                     help='defaults to a SQLite file in the temp directory')
+    cmd.add_argument('--entries', type=int, default=100000)
+    cmd.add_argument('--queries', type=int, default=50,
+                     help='searches run for each kind of query')
+    cmd.add_argument('--pages', type=int, default=5,
+                     help='results pages followed for each search')
+    cmd.add_argument('--page-size', type=int, default=20)
+    cmd.add_argument('--budget-ms', type=float, default=SEARCH_BUDGET_MS,
+                     help='fail if any p95 is slower than this (0 to skip)')
+    cmd.set_defaults(func=bench_search)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""Bulk import and export of entries
+
+Imports read JSON lines (one {"title", "content", "date"} object per
+line) or Markdown files with a front matter block:
+
+    ---
+    title: Decorators
+    date: 2015-07-14
+    ---
+    Entry text...
+
+and insert them in batches, one transaction per batch, with COPY on
+PostgreSQL and executemany elsewhere. Only one batch is held in memory
+at a time. After each batch the number of records done so far is saved
+to a progress file, so an interrupted import can pick up where it
+stopped. A record without a title or content, or with a date that can't
+be read, stops the import with a ValueError naming the file and line;
+fix it and resume.
+
+Exports stream entries back out in either format, in id order, a batch
+of rows at a time.
+"""
+from __future__ import unicode_literals
+import datetime
+import io
+import json
+import os
+
+import journal
+
+try:
+    string_types = basestring
+except NameError:  # pragma: no cover
+    string_types = str
+
+
+BATCH_SIZE = 500
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+COLUMNS = (
+    'title', 'date', 'content', 'content_html', 'content_hash',
+    'renderer_version', 'updated_at'
+)
+
+
+def parse_date(value):
+    """Read the dates written by export, or a plain YYYY-MM-DD"""
+    value = value.strip().replace(' ', 'T')
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('unrecognised date: {}'.format(value))
+
+
+def format_date(value):
+    return value.strftime(DATE_FORMATS[0])
+
+
+def check_record(record, where):
+    """Raise ValueError, saying `where` it came from, if `record` won't do"""
+    if not isinstance(record, dict):
+        raise ValueError('{}: expected an object'.format(where))
+    for key in ('title', 'content'):
+        if not isinstance(record.get(key), string_types):
+            raise ValueError('{}: no {}'.format(where, key))
+    if record.get('date'):
+        try:
+            parse_date(record['date'])
+        except (ValueError, AttributeError):
+            raise ValueError(
+                '{}: unrecognised date: {}'.format(where, record['date']))
+    return record
+
+
+def read_jsonl(path):
+    """Yield the records in a JSON lines file"""
+    with io.open(path, encoding='utf-8') as lines:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            where = '{}:{}'.format(path, number)
+            try:
+                record = json.loads(line)
+            except ValueError as err:
+                raise ValueError('{}: {}'.format(where, err))
+            yield check_record(record, where)
+
+
+def parse_front_matter(text):
+    """Split a Markdown file into its front matter fields and its body
+
+    Front matter is only a block that starts on the first line with a
+    line of `---` and ends with the next such line; a `---` anywhere
+    else is a horizontal rule in the body.
+    """
+    record = {}
+    lines = text.splitlines(True)
+    if lines and lines[0].rstrip() == '---':
+        closing = next((
+            number for number, line in enumerate(lines[1:], 1)
+            if line.rstrip() == '---'
+        ), None)
+        if closing is not None:
+            for line in lines[1:closing]:
+                key, sep, value = line.partition(':')
+                if sep:
+                    record[key.strip().lower()] = value.strip()
+            text = ''.join(lines[closing + 1:]).lstrip('\n')
+    record['content'] = text
+    return record
+
+
+def read_markdown(path):
+    """Yield a record for each .md file in a directory (or a single file)"""
+    if os.path.isdir(path):
+        names = sorted(n for n in os.listdir(path) if n.endswith('.md'))
+        paths = [os.path.join(path, name) for name in names]
+    else:
+        paths = [path]
+    for md_path in paths:
+        with io.open(md_path, encoding='utf-8') as md_file:
+            yield check_record(parse_front_matter(md_file.read()), md_path)
+
+
+READERS = {'jsonl': read_jsonl, 'markdown': read_markdown}
+
+
+def to_row(record, now, render=True):
+    """Make an entries row, stored HTML and all, out of an imported record
+
+    With `render` False the HTML is left out, for a render job to fill in.
+    """
+    content = record['content']
+    date = record.get('date')
+    row = {
+        'title': record['title'],
+        'date': parse_date(date) if date else now,
+        'content': content,
+        'content_html': None,
+        'content_hash': None,
+        'renderer_version': None,
+        'updated_at': now,
+    }
+    if render:
+        row.update(
+            content_html=journal.render_markdown(content),
+            content_hash=journal.content_hash(content),
+            renderer_version=journal.RENDERER_VERSION,
+        )
+    return row
+
+
+def csv_field(value):
+    """Quote a value for COPY ... WITH CSV; None stays unquoted, as NULL"""
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        value = format_date(value)
+    return '"{}"'.format('{}'.format(value).replace('"', '""'))
+
+
+def insert_rows(conn, rows):
+    """Insert a batch of rows, with COPY if the database has it"""
+    if conn.dialect.name != 'postgresql':
+        conn.execute(journal.Entry.__table__.insert(), rows)
+        return
+    lines = (
+        ','.join(csv_field(row[column]) for column in COLUMNS) + '\n'
+        for row in rows
+    )
+    buf = io.BytesIO(''.join(lines).encode('utf-8'))
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        'COPY entries ({}) FROM STDIN WITH CSV'.format(', '.join(COLUMNS)),
+        buf
+    )
+
+
+def load_progress(path):
+    if path and os.path.exists(path):
+        with io.open(path) as progress:
+            return json.load(progress)
+    return {}
+
+
+def save_progress(path, progress):
+    if not path:
+        return
+    with io.open(path + '.tmp', 'w') as out:
+        out.write('{}'.format(json.dumps(progress)))
+    os.rename(path + '.tmp', path)
+
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_entries(engine, sources, file_format='jsonl',
+                   batch_size=BATCH_SIZE, progress_path=None, resume=False,
+                   log=None):
+    """Load entries from `sources` into the database
+
+    Returns the number of entries inserted.
+    """
+    progress = load_progress(progress_path) if resume else {}
+    read = READERS[file_format]
+    total = 0
+    for source in sources:
+        key = os.path.abspath(source)
+        done = progress.get(key, 0)
+        records = read(source)
+        for skipped in range(done):
+            next(records, None)
+        for batch in batches(records, batch_size):
+            now = datetime.datetime.utcnow()
+            rows = [to_row(record, now) for record in batch]
+            with engine.begin() as conn:
+                insert_rows(conn, rows)
+            done += len(rows)
+            total += len(rows)
+            progress[key] = done
+            save_progress(progress_path, progress)
+            if log is not None:
+                log('{}: {} entries'.format(source, done))
+    return total
+
+
+def export_rows(session, batch_size=BATCH_SIZE):
+    """Stream (id, title, date, content) for every entry, in id order"""
+    Entry = journal.Entry
+    return session.query(
+        Entry.id, Entry.title, Entry.date, Entry.content
+    ).order_by(Entry.id).yield_per(batch_size)
+
+
+def export_jsonl(session, out, batch_size=BATCH_SIZE):
+    """Write every entry as a line of JSON to the text stream `out`"""
+    count = 0
+    for row in export_rows(session, batch_size):
+        record = {
+            'title': row.title,
+            'date': format_date(row.date),
+            'content': row.content,
+        }
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def export_markdown(session, directory, batch_size=BATCH_SIZE):
+    """Write every entry as <id>.md, with front matter, into `directory`"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    count = 0
+    for row in export_rows(session, batch_size):
+        path = os.path.join(directory, '{:06d}.md'.format(row.id))
+        with io.open(path, 'w', encoding='utf-8') as out:
+            out.write('---\ntitle: {}\ndate: {}\n---\n{}'.format(
+                row.title, format_date(row.date), row.content
+            ))
+        count += 1
+    return count
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Gzip compression of responses
+
+A tween compresses responses for clients that send Accept-Encoding: gzip.
+It leaves alone bodies too small to gain anything, content types that are
+already compressed (images, archives, fonts) and responses that already
+have a Content-Encoding, such as the precompressed files from assets.py.
+Every response that could be compressed gets Vary: Accept-Encoding,
+whether or not this client got it compressed, so shared caches keep the
+variants apart.
+
+A compressed body isn't byte-for-byte the entity its ETag was made for,
+so compressed responses get a weak ETag. Clients send that back in
+If-None-Match, and WebOb (with views' `not_modified`) compares tags
+weakly, so revalidation keeps working for both variants.
+
+Configured with COMPRESS_MIN_SIZE (bytes, default 1024) and COMPRESS_LEVEL
+(1-9, default 6).
+"""
+from __future__ import unicode_literals
+import os
+import zlib
+
+from pyramid.tweens import EXCVIEW, INGRESS
+
+
+MIN_SIZE = 1024
+LEVEL = 6
+COMPRESSIBLE = (
+    'text/', 'application/json', 'application/javascript',
+    'application/xml', 'application/atom+xml', 'application/rss+xml',
+    'image/svg+xml',
+)
+
+
+def settings_from_environ(settings):
+    """Copy the COMPRESS_* environment variables into app settings"""
+    settings['compression.min_size'] = os.environ.get(
+        'COMPRESS_MIN_SIZE', MIN_SIZE
+    )
+    settings['compression.level'] = os.environ.get('COMPRESS_LEVEL', LEVEL)
+
+
+def compressor(level):
+    # wbits of 16 + MAX_WBITS makes zlib write a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_iter(app_iter, level):
+    """Compress a streamed body as it goes"""
+    squeeze = compressor(level)
+    try:
+        for chunk in app_iter:
+            packed = squeeze.compress(chunk)
+            if packed:
+                yield packed
+        yield squeeze.flush()
+    finally:
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def is_compressible(response):
+    content_type = response.content_type or ''
+    return content_type.startswith(COMPRESSIBLE)
+
+
+def add_vary(response, header):
+    vary = response.vary or ()
+    if header.lower() not in [name.lower() for name in vary]:
+        response.vary = tuple(vary) + (str(header),)
+
+
+def weaken_etag(response):
+    etag = response.etag
+    if etag is not None:
+        response.etag = (etag, False)
+
+
+def tween_factory(handler, registry):
+    settings = registry.settings
+    min_size = int(settings.get('compression.min_size', MIN_SIZE))
+    level = int(settings.get('compression.level', LEVEL))
+
+    def compression_tween(request):
+        response = handler(request)
+        wants_gzip = request.accept_encoding.quality('gzip')
+        if response.status_int == 304:
+            # answer in kind: a client revalidating the compressed
+            # variant sent its weak tag, and should get it back
+            etag = response.etag
+            if wants_gzip and etag is not None and 'W/"{}"'.format(etag) in \
+                    request.headers.get('If-None-Match', ''):
+                weaken_etag(response)
+            return response
+        if (
+            response.status_int != 200 or response.content_encoding or
+            not is_compressible(response)
+        ):
+            return response
+        length = response.content_length
+        if length is not None and length < min_size:
+            return response
+        add_vary(response, 'Accept-Encoding')
+        if not wants_gzip:
+            return response
+        if length is None:
+            # streamed, length unknown: compress as it goes out
+            response.app_iter = gzip_iter(response.app_iter, level)
+            response.content_length = None
+        else:
+            squeeze = compressor(level)
+            response.body = squeeze.compress(response.body) + squeeze.flush()
+        response.content_encoding = str('gzip')
+        weaken_etag(response)
+        return response
+
+    return compression_tween
+
+
+def includeme(config):
+    # inside the metrics tween, when there is one, so that request timings
+    # include compression
+    config.add_tween(
+        'compression.tween_factory',
+        under=('metrics.tween_factory', INGRESS), over=EXCVIEW
+    )
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Pick the database the tests run against, one per test process
+
+The tests use DATABASE_URL if it is set, and otherwise a SQLite file in
+a temporary directory, so they need no database server. Run across
+every core with pytest-xdist:
+
+    py.test -n auto
+
+and each worker process gets a database of its own, named after the
+worker: worker gw0 uses `test-learning-journal-gw0` for a PostgreSQL
+DATABASE_URL naming `test-learning-journal`, or `journal-gw0.db` for a
+SQLite `journal.db`. So workers never see each other's entries or wait
+on each other's locks. Those
+databases are created for the run, PostgreSQL ones on the same server
+as DATABASE_URL, and dropped after it.
+
+This runs before the test modules are imported, since journal.py makes
+its engine from DATABASE_URL on import. It can't run any sooner: xdist
+only tells a worker which one it is after loading its conftest.py files,
+so none of them may import journal at the top.
+"""
+from __future__ import unicode_literals
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+import sqlalchemy as sa
+
+import dbpool
+
+
+def worker_id(config):
+    """The xdist worker this process is ('gw0', ...), or None"""
+    worker = getattr(config, 'slaveinput', None) or \
+        getattr(config, 'workerinput', None)
+    if worker is None:
+        return None
+    return worker.get('slaveid') or worker.get('workerid')
+
+
+def worker_url(url, worker):
+    """`url` with the worker's name worked into the database's name"""
+    url = sa.engine.url.make_url(url)
+    root, ext = os.path.splitext(url.database)
+    url.database = '{}-{}{}'.format(root, worker, ext)
+    return url
+
+
+def server_url(url):
+    """Where to connect to create and drop `url`'s PostgreSQL database"""
+    return sa.engine.url.URL(
+        url.drivername, url.username, url.password, url.host, url.port,
+        'postgres', url.query
+    )
+
+
+def sqlite_files(url):
+    return [url.database + suffix for suffix in ('', '-wal', '-shm')]
+
+
+def create_database(url):
+    if url.drivername.startswith('sqlite'):
+        drop_database(url)
+        return
+    server = sa.create_engine(server_url(url), isolation_level='AUTOCOMMIT')
+    with server.connect() as conn:
+        conn.execute('DROP DATABASE IF EXISTS "{}"'.format(url.database))
+        conn.execute('CREATE DATABASE "{}"'.format(url.database))
+    server.dispose()
+
+
+def drop_database(url):
+    if url.drivername.startswith('sqlite'):
+        for path in sqlite_files(url):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+    server = sa.create_engine(server_url(url), isolation_level='AUTOCOMMIT')
+    with server.connect() as conn:
+        conn.execute('DROP DATABASE IF EXISTS "{}"'.format(url.database))
+    server.dispose()
+
+
+def pytest_configure(config):
+    if 'journal' in sys.modules:
+        raise pytest.UsageError(
+            'journal was imported before the test database was picked; '
+            'import it inside fixtures in conftest.py files')
+    config._journal_cleanup = []
+    url = os.environ.get('DATABASE_URL')
+    if url is None:
+        directory = tempfile.mkdtemp(prefix='journal-test-')
+        config._journal_cleanup.append(
+            lambda: shutil.rmtree(directory, ignore_errors=True))
+        url = 'sqlite:///{}'.format(os.path.join(directory, 'journal.db'))
+    worker = worker_id(config)
+    if worker is not None and not dbpool.is_memory(url):
+        url = worker_url(url, worker)
+        create_database(url)
+        config._journal_cleanup.append(lambda: drop_database(url))
+    os.environ['DATABASE_URL'] = '{}'.format(url)
+
+
+def pytest_unconfigure(config):
+    journal = sys.modules.get('journal')
+    if journal is not None:
+        # let go of the database before it's dropped
+        journal.engine.dispose()
+    for cleanup in reversed(getattr(config, '_journal_cleanup', [])):
+        cleanup()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""The database engine and its connection pool
+
+There is one engine per process. Its pool is configured from the
+environment:
+
+    DB_POOL_SIZE       connections kept open (default 5)
+    DB_MAX_OVERFLOW    extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT    seconds to wait for a connection (default 30)
+    DB_POOL_RECYCLE    seconds before a connection is replaced (default 3600)
+    DB_POOL_PRE_PING   check connections are alive on checkout (default on)
+
+and keeps statistics on checkouts, waits, overflow and timeouts for
+monitoring.
+
+A `sqlite:///path` DATABASE_URL runs the journal on an embedded SQLite
+file instead of a database server. Connections to it are pooled the same
+way, and each is set up to behave like PostgreSQL where the app relies
+on it: foreign keys (and their ON DELETE CASCADE) are enforced,
+transactions begin with their first statement, reads included, rather
+than their first write, and the file is in WAL mode, so readers don't
+block the writer or each other. A connection waits up to
+
+    DB_BUSY_TIMEOUT    seconds for another's write to finish (default 30)
+
+before giving up with "database is locked". That wait only covers taking
+the write lock, though, not a transaction that has read from its
+snapshot and then wants to write after another has committed: SQLite
+fails that at once. So transactions that are going to write begin
+IMMEDIATE, taking the lock up front; that's those begun inside
+`writing()`, which covers every request that isn't a GET, HEAD or
+OPTIONS. In-memory SQLite databases
+(`sqlite://`) are one per connection, so they keep SQLAlchemy's
+single-connection-per-thread pool and the pool settings don't apply.
+"""
+from __future__ import unicode_literals
+import bisect
+import contextlib
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# upper bounds, in seconds, of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+SQLITE_PRAGMAS = (
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA journal_mode = WAL',
+    # safe with WAL: a power cut can lose the last commits, not corrupt
+    'PRAGMA synchronous = NORMAL',
+)
+
+_local = threading.local()
+
+
+def asbool(value):
+    return '{}'.format(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class PoolStats(object):
+    """Counters and a wait-time histogram for one pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def record_wait(self, seconds, overflowed=False, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            if overflowed:
+                self.overflows += 1
+            self.wait_sum += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'overflows': self.overflows,
+                'timeouts': self.timeouts,
+                'wait_sum': self.wait_sum,
+                'wait_max': self.wait_max,
+                'wait_buckets': list(zip(
+                    WAIT_BUCKETS + ('+Inf',), self.wait_buckets
+                )),
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that times how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kw):
+        super(InstrumentedQueuePool, self).__init__(*args, **kw)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        pool = super(InstrumentedQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.time()
+        overflow = self._overflow
+        try:
+            conn = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.stats.record_wait(time.time() - start, timed_out=True)
+            raise
+        # _overflow counts up from -pool_size as connections are opened,
+        # so it only goes past zero when this checkout opened an extra one
+        self.stats.record_wait(
+            time.time() - start, overflowed=self._overflow > max(overflow, 0)
+        )
+        return conn
+
+
+def ping(connection, branch):
+    """Make sure a connection still works before using it
+
+    This is SQLAlchemy's "pessimistic disconnect handling" recipe: a stale
+    connection fails the ping, gets invalidated (along with the rest of
+    the pool) and the ping is retried on a fresh one.
+    """
+    if branch:
+        return
+    should_close = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(sa.select([1]))
+    except exc.DBAPIError as err:
+        if not err.connection_invalidated:
+            raise
+        connection.scalar(sa.select([1]))
+    finally:
+        connection.should_close_with_result = should_close
+
+
+def sqlite_connect(dbapi_connection, connection_record):
+    # pysqlite only BEGINs before writes; leave it to sqlite_begin
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+@contextlib.contextmanager
+def writing():
+    """SQLite transactions this thread begins in here take the write lock"""
+    was = getattr(_local, 'writing', False)
+    _local.writing = True
+    try:
+        yield
+    finally:
+        _local.writing = was
+
+
+def sqlite_begin(connection):
+    if getattr(_local, 'writing', False):
+        connection.execute('BEGIN IMMEDIATE')
+    else:
+        connection.execute('BEGIN')
+
+
+def is_memory(url):
+    return sa.engine.url.make_url(url).database in (None, '', ':memory:')
+
+
+def make_engine(url, environ):
+    """Create the process's engine, configured from `environ`"""
+    kw = {}
+    sqlite = url.startswith('sqlite')
+    if not (sqlite and is_memory(url)):
+        kw.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=int(environ.get('DB_POOL_SIZE', 5)),
+            max_overflow=int(environ.get('DB_MAX_OVERFLOW', 10)),
+            pool_timeout=float(environ.get('DB_POOL_TIMEOUT', 30)),
+            pool_recycle=int(environ.get('DB_POOL_RECYCLE', 3600)),
+        )
+    if sqlite:
+        # pooled connections move between request threads, which is safe
+        # as long as only one thread uses a connection at a time
+        kw['connect_args'] = {
+            'timeout': float(environ.get('DB_BUSY_TIMEOUT', 30)),
+            'check_same_thread': False,
+        }
+    engine = sa.create_engine(url, **kw)
+    if sqlite:
+        sa.event.listen(engine, 'connect', sqlite_connect)
+        sa.event.listen(engine, 'begin', sqlite_begin)
+    if asbool(environ.get('DB_POOL_PRE_PING', 'on')):
+        sa.event.listen(engine, 'engine_connect', ping)
+    return engine
+
+
+def pool_stats(engine):
+    """What the engine's pool is doing right now, and has done so far"""
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(pool.stats.snapshot())
+    return stats
+
+
+def tween_factory(handler, registry):
+    def writing_tween(request):
+        if request.method in SAFE_METHODS:
+            return handler(request)
+        with writing():
+            return handler(request)
+
+    return writing_tween
+
+
+def includeme(config):
+    # outside the transaction, so it knows before the transaction begins
+    config.add_tween('dbpool.tween_factory',
+                     over='pyramid_tm.tm_tween_factory')
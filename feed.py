@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""An Atom feed of the newest entries, at /feed.atom
+
+Feed readers poll, so the feed is built to be cheap to ask for again.
+Its ETag is a hash of the ids and update times of the FEED_SIZE newest
+entries, which the listing's (date, id) index gives up without reading
+any entry content. A reader whose copy is current gets a 304 for the
+price of that one query.
+
+Otherwise the serialized feed is served from a copy kept in this process
+as long as its ETag still matches. After entries change it is streamed
+to the reader a piece at a time from stored HTML, and the copy is kept
+once the last piece has gone out.
+
+With FEED_HUBS set (a comma separated list of WebSub hub URLs), the feed
+names those hubs, and every change to entries queues a background job
+that tells them the feed has changed, so subscribers hear about new
+entries without polling.
+"""
+from __future__ import unicode_literals
+import os
+import threading
+
+from markupsafe import escape
+
+try:
+    from urllib import urlencode
+    from urllib2 import urlopen
+except ImportError:  # pragma: no cover
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+
+import jobs
+import journal
+
+
+FEED_SIZE = 20
+TITLE = "Jesse's Learning Journal"
+AUTHOR = 'Jesse Klein'
+CONTENT_TYPE = str('application/atom+xml')
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+PING_TIMEOUT = 10
+
+_feed = {}
+_lock = threading.Lock()
+
+
+def settings_from_environ(settings):
+    settings['feed.size'] = os.environ.get('FEED_SIZE', FEED_SIZE)
+    settings['feed.hubs'] = [
+        hub.strip() for hub in os.environ.get('FEED_HUBS', '').split(',')
+        if hub.strip()
+    ]
+
+
+def timestamp(value):
+    # entries' times are UTC
+    return value.strftime(TIME_FORMAT)
+
+
+def newest(session, size):
+    """(id, updated_at) of the entries the feed shows, newest first"""
+    Entry = journal.Entry
+    return session.query(Entry.id, Entry.updated_at).order_by(
+        Entry.date.desc(), Entry.id.desc()
+    ).limit(size).all()
+
+
+def hub_urls(request):
+    return request.registry.settings.get('feed.hubs') or []
+
+
+def fingerprint(request, rows):
+    """The feed's ETag and Last-Modified, from newest()'s rows"""
+    # the host is in there because the feed's links are absolute
+    etag = journal.make_etag(
+        request.host_url, journal.RENDERER_VERSION,
+        ','.join(hub_urls(request)),
+        *['{}@{}'.format(entry_id, updated) for entry_id, updated in rows]
+    )
+    times = [updated for entry_id, updated in rows if updated is not None]
+    return etag, max(times) if times else None
+
+
+def entry_html(row):
+    if journal.html_is_stale(row):
+        return journal.render_markdown(row.content)
+    return row.content_html
+
+
+def write_feed(request, entries, updated):
+    """Yield the feed's XML a piece at a time"""
+    home = request.route_url('home')
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield '<title>{}</title>\n'.format(escape(TITLE))
+    yield '<id>{}</id>\n'.format(escape(home))
+    yield '<link rel="alternate" type="text/html" href="{}"/>\n'.format(
+        escape(home))
+    yield '<link rel="self" href="{}"/>\n'.format(
+        escape(request.route_url('feed')))
+    for hub in hub_urls(request):
+        yield '<link rel="hub" href="{}"/>\n'.format(escape(hub))
+    if updated is not None:
+        yield '<updated>{}</updated>\n'.format(timestamp(updated))
+    yield '<author><name>{}</name></author>\n'.format(escape(AUTHOR))
+    for entry in entries:
+        link = request.route_url('detail', _query={'id': entry.id})
+        yield (
+            '<entry>\n<title>{}</title>\n<id>{}</id>\n'
+            '<link rel="alternate" type="text/html" href="{}"/>\n'
+            '<published>{}</published>\n<updated>{}</updated>\n'
+            '<content type="html">{}</content>\n</entry>\n'
+        ).format(
+            escape(entry.title), escape(link), escape(link),
+            timestamp(entry.date),
+            timestamp(entry.updated_at or entry.date),
+            escape(entry_html(entry)),
+        )
+    yield '</feed>\n'
+
+
+def build(request, session, size):
+    """Start serializing the feed; returns (etag, last modified, chunks)
+
+    The entries are read here, while the request's transaction is open,
+    into plain rows, so that the chunks can be written out after the view
+    has returned.
+    """
+    Entry = journal.Entry
+    entries = session.query(
+        Entry.id, Entry.title, Entry.date, Entry.updated_at, Entry.content,
+        Entry.content_html, Entry.content_hash, Entry.renderer_version,
+    ).order_by(Entry.date.desc(), Entry.id.desc()).limit(size).all()
+    etag, updated = fingerprint(
+        request, [(entry.id, entry.updated_at) for entry in entries])
+    chunks = (
+        chunk.encode('utf-8')
+        for chunk in write_feed(request, entries, updated)
+    )
+    return etag, updated, chunks
+
+
+def keep(etag, updated, chunks):
+    """Pass the feed's chunks on, keeping the whole once they are all out"""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    with _lock:
+        _feed['latest'] = (etag, updated, b''.join(parts))
+
+
+def feed_view(request):
+    session = journal.DBSession
+    size = int(request.registry.settings.get('feed.size', FEED_SIZE))
+    etag, updated = fingerprint(request, newest(session, size))
+    unchanged = journal.not_modified(request, etag, updated)
+    if unchanged is not None:
+        return unchanged
+    with _lock:
+        cached = _feed.get('latest')
+    response = request.response
+    response.content_type = CONTENT_TYPE
+    response.charset = str('utf-8')
+    if cached is not None and cached[0] == etag:
+        etag, updated, body = cached
+        response.body = body
+    else:
+        etag, updated, chunks = build(request, session, size)
+        response.app_iter = keep(etag, updated, chunks)
+        response.content_length = None
+    response.etag = etag
+    if updated is not None:
+        response.last_modified = updated
+    return response
+
+
+def ping_later(event):
+    """Queue a ping of the hubs, in the transaction that changed entries"""
+    if hub_urls(event.request):
+        jobs.enqueue(journal.DBSession, 'ping_hubs', {
+            'hubs': hub_urls(event.request),
+            'url': event.request.route_url('feed'),
+        })
+
+
+@jobs.handler('ping_hubs')
+def ping_hubs(session, hubs, url):
+    """Tell WebSub hubs that the feed at `url` has changed"""
+    body = urlencode({'hub.mode': 'publish', 'hub.url': url})
+    for hub in hubs:
+        urlopen(hub, body.encode('utf-8'), PING_TIMEOUT).close()
+
+
+def includeme(config):
+    config.add_route('feed', '/feed.atom')
+    config.add_view(feed_view, route_name='feed')
+    config.add_subscriber(ping_later, journal.EntriesChanged)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Syntax highlighting for code blocks in entries
+
+Pygments can style highlighted code two ways:
+
+    inline   every token carries a style="color: ..." attribute (the default)
+    classes  tokens carry short class names, styled by one stylesheet
+
+Both look the same. Class names make the stored HTML, and so every detail
+page, a good deal smaller, and the stylesheet is a static file that
+browsers cache. It is generated from the Pygments style on startup and
+built with the static files by assets.py, as STYLESHEET, so it is
+fingerprinted and cached like any of them.
+"""
+from __future__ import unicode_literals
+import re
+
+
+MODES = ('inline', 'classes')
+STYLE = 'default'
+CSS_CLASS = 'codehilite'
+# the stylesheet's name among the assets
+STYLESHEET = 'pygments.css'
+
+_formatter = None
+_unstyled_span = None
+
+
+def formatter():
+    """The Pygments formatter for STYLE, built the first time it's needed"""
+    global _formatter
+    if _formatter is None:
+        from pygments.formatters import HtmlFormatter
+        _formatter = HtmlFormatter(style=STYLE)
+    return _formatter
+
+
+def unstyled_span():
+    """A pattern for spans around tokens the style gives no color or weight
+
+    Inline mode leaves these tokens bare, so classes mode unwraps them too
+    rather than paying for a <span> that does nothing.
+    """
+    global _unstyled_span
+    if _unstyled_span is None:
+        from pygments.token import STANDARD_TYPES
+        unstyled = sorted(
+            set(STANDARD_TYPES.values()) - set(formatter().class2style) -
+            {''}
+        )
+        _unstyled_span = re.compile(
+            r'<span class="(?:{})">([^<]*)</span>'.format('|'.join(unstyled))
+        )
+    return _unstyled_span
+
+
+def markdown_config(mode):
+    """The codehilite extension config for a highlighting mode"""
+    if mode not in MODES:
+        raise ValueError('unknown highlighting mode: {}'.format(mode))
+    return {
+        'markdown.extensions.codehilite': {
+            'noclasses': mode == 'inline',
+            'pygments_style': STYLE,
+            'css_class': CSS_CLASS,
+        }
+    }
+
+
+def strip_unstyled(html):
+    """Drop the spans classes mode puts around tokens that have no style"""
+    return unstyled_span().sub(r'\1', html)
+
+
+def stylesheet():
+    """The CSS for classes mode, matching what inline mode would produce"""
+    return '{}\n.{} pre {{ line-height: 125%; }}\n'.format(
+        formatter().get_style_defs('.' + CSS_CLASS), CSS_CLASS
+    )
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""Background jobs, queued in the database
+
+Work that a write causes but the author needn't wait for, like rendering
+an entry's Markdown or pinging feed hubs, is queued as a row in the
+`jobs` table, in the same transaction as the write: if the write rolls
+back so does the job, and once it commits the job can't be lost.
+
+    jobs.enqueue(session, 'render', {'entry_id': 1, 'version': 3},
+                 key='render:1:3')
+
+A `key` makes enqueueing idempotent: while a job with that key is in
+the table, queueing it again does nothing.
+
+Jobs are run by a Runner, on JOB_THREADS threads (2 by default) in each
+web server process, or, with JOB_THREADS=0, by a separate worker process:
+
+    python manage.py jobs
+
+Runners claim due jobs with a conditional UPDATE, so any number of them
+can share the table. A claimed job is leased for JOB_LEASE_SECONDS (300
+by default); if its runner dies, another takes the job over once the
+lease runs out. A job that raises is tried again after 2, 4, 8 ...
+seconds, up to its `max_attempts`, and then marked failed along with its
+error. A job may run more than once, so handlers should be idempotent;
+whatever a handler writes with the session it is given commits in the
+same transaction that marks the job done. Runners delete done jobs once
+they are JOB_KEEP_SECONDS old (a day by default), so keys should only
+need to tell apart jobs queued within about that long of each other.
+Failed jobs are kept until they are requeued.
+
+/metrics shows the number of jobs in each state and how long the oldest
+due job has been waiting, for the whole queue, and for the jobs this
+process ran, how long they waited and took, and how they turned out.
+"""
+from __future__ import unicode_literals
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session, sessionmaker
+
+import dbpool
+import metrics
+import workers
+
+
+log = logging.getLogger('journal.jobs')
+
+THREADS = 2
+POLL_SECONDS = 5
+LEASE_SECONDS = 300
+KEEP_SECONDS = 24 * 3600
+PRUNE_SECONDS = 600
+MAX_ATTEMPTS = 5
+RETRY_SECONDS = 2
+MAX_RETRY_SECONDS = 3600
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+HANDLERS = {}
+# runners started in this process, woken when a transaction queues a job
+_runners = []
+
+
+def settings_from_environ(settings):
+    settings['jobs.threads'] = os.environ.get('JOB_THREADS', THREADS)
+    settings['jobs.poll_seconds'] = os.environ.get(
+        'JOB_POLL_SECONDS', POLL_SECONDS)
+    settings['jobs.lease_seconds'] = os.environ.get(
+        'JOB_LEASE_SECONDS', LEASE_SECONDS)
+    settings['jobs.keep_seconds'] = os.environ.get(
+        'JOB_KEEP_SECONDS', KEEP_SECONDS)
+
+
+def as_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def job_model():
+    # journal registers its handlers with this module as it's imported,
+    # so this module only imports journal once it's running
+    import journal
+    return journal.Job
+
+
+def handler(name):
+    """Register a function to run jobs called `name`
+
+    It is called with a session and the job's payload as keyword
+    arguments.
+    """
+    def register(func):
+        HANDLERS[name] = func
+        return func
+    return register
+
+
+def insert_statement(dialect, values):
+    """An INSERT of `values` that does nothing if their key is taken"""
+    table = job_model().__table__
+    if dialect == 'postgresql':
+        names = sorted(values)
+        return sa.text(
+            'INSERT INTO jobs ({}) VALUES ({}) '
+            'ON CONFLICT (idempotency_key) DO NOTHING'.format(
+                ', '.join(names), ', '.join(':' + name for name in names))
+        )
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+
+def enqueue(session, name, payload=None, key=None, max_attempts=MAX_ATTEMPTS,
+            delay=0):
+    """Queue a job in the session's transaction
+
+    Returns False if a job with the same `key` was queued already.
+    """
+    now = datetime.datetime.utcnow()
+    values = {
+        'name': name,
+        'idempotency_key': key,
+        'payload': as_text(json.dumps(payload or {}, sort_keys=True)),
+        'state': QUEUED,
+        'attempts': 0,
+        'max_attempts': max_attempts,
+        'run_at': now + datetime.timedelta(seconds=delay),
+        'created': now,
+    }
+    Job = job_model()
+    if key is not None:
+        dialect = session.connection().dialect.name
+        if dialect not in ('postgresql', 'sqlite') and session.query(
+                Job.id).filter(Job.idempotency_key == key).first():
+            return False
+        result = session.execute(insert_statement(dialect, values), values)
+    else:
+        result = session.execute(Job.__table__.insert(), values)
+    if result.rowcount == 0:
+        return False
+    session.info['jobs_queued'] = True
+    return True
+
+
+def wake_runners(session):
+    if session.info.pop('jobs_queued', False):
+        for runner in list(_runners):
+            runner.wake()
+
+
+def forget_queued(session, *args):
+    session.info.pop('jobs_queued', None)
+
+
+sa.event.listen(Session, 'after_commit', wake_runners)
+sa.event.listen(Session, 'after_rollback', forget_queued)
+
+
+def claim(session, limit, lease_seconds=LEASE_SECONDS, now=None):
+    """Take up to `limit` due jobs; returns their (id, attempt)s
+
+    Jobs whose lease ran out with no attempts left are failed instead.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    Job = job_model()
+    table = Job.__table__
+    due = session.query(
+        Job.id, Job.state, Job.attempts, Job.max_attempts
+    ).filter(
+        Job.state.in_((QUEUED, RUNNING)), Job.run_at <= now
+    ).order_by(Job.run_at, Job.id).limit(limit).all()
+    claimed = []
+    for job in due:
+        # only if no other runner got there first
+        mine = table.update().where(sa.and_(
+            table.c.id == job.id, table.c.state == job.state,
+            table.c.attempts == job.attempts,
+        ))
+        if job.attempts >= job.max_attempts:
+            session.execute(mine.values(
+                state=FAILED, finished=now,
+                error='lease ran out on the last attempt'))
+            continue
+        result = session.execute(mine.values(
+            state=RUNNING, attempts=job.attempts + 1,
+            run_at=now + datetime.timedelta(seconds=lease_seconds),
+        ))
+        if result.rowcount == 1:
+            claimed.append((job.id, job.attempts + 1))
+    return claimed
+
+
+def retry_delay(attempt):
+    return min(RETRY_SECONDS * 2 ** (attempt - 1), MAX_RETRY_SECONDS)
+
+
+def finish(session, job_id, attempt, error=None, max_attempts=None):
+    """Record how an attempt at a job went
+
+    Returns the outcome: 'done', 'retry', 'failed', or 'lost' if the
+    lease ran out and another runner has the job now.
+    """
+    now = datetime.datetime.utcnow()
+    table = job_model().__table__
+    if error is None:
+        outcome, values = DONE, {'state': DONE, 'finished': now,
+                                 'error': None}
+    elif attempt >= max_attempts:
+        outcome, values = FAILED, {'state': FAILED, 'finished': now,
+                                   'error': error}
+    else:
+        outcome, values = 'retry', {
+            'state': QUEUED, 'error': error,
+            'run_at': now + datetime.timedelta(seconds=retry_delay(attempt)),
+        }
+    result = session.execute(table.update().where(sa.and_(
+        table.c.id == job_id, table.c.state == RUNNING,
+        table.c.attempts == attempt,
+    )).values(**values))
+    return outcome if result.rowcount == 1 else 'lost'
+
+
+def requeue_failed(session):
+    """Give every failed job a fresh set of attempts; returns how many"""
+    table = job_model().__table__
+    return session.execute(table.update().where(
+        table.c.state == FAILED
+    ).values(
+        state=QUEUED, attempts=0, finished=None,
+        run_at=datetime.datetime.utcnow()
+    )).rowcount
+
+
+def prune(session, keep_seconds=KEEP_SECONDS, now=None):
+    """Delete jobs done more than `keep_seconds` ago; returns how many"""
+    if now is None:
+        now = datetime.datetime.utcnow()
+    table = job_model().__table__
+    return session.execute(table.delete().where(sa.and_(
+        table.c.state == DONE,
+        table.c.finished < now - datetime.timedelta(seconds=keep_seconds),
+    ))).rowcount
+
+
+class Runner(object):
+    """Claims due jobs and runs them, each in its own transaction
+
+    `start` works the queue on `threads` threads until `stop`, pruning
+    old done jobs every PRUNE_SECONDS; `run_pending` runs whatever is
+    due in the calling thread.
+    """
+
+    def __init__(self, engine, threads=THREADS, poll_seconds=POLL_SECONDS,
+                 lease_seconds=LEASE_SECONDS, keep_seconds=KEEP_SECONDS):
+        self.make_session = sessionmaker(bind=engine)
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.keep_seconds = keep_seconds
+        self.pruned = None
+        self.running = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._pool = None
+        self._thread = None
+
+    def claim(self, limit):
+        session = self.make_session()
+        try:
+            # read then written, so it takes SQLite's write lock up front
+            with dbpool.writing():
+                claimed = claim(session, limit, self.lease_seconds)
+                session.commit()
+            return claimed
+        finally:
+            session.close()
+
+    def prune(self):
+        session = self.make_session()
+        try:
+            count = prune(session, self.keep_seconds)
+            session.commit()
+        finally:
+            session.close()
+        self.pruned = time.time()
+        return count
+
+    def run(self, job_id, attempt):
+        """Run one claimed job; returns its outcome"""
+        with dbpool.writing():
+            return self._run(job_id, attempt)
+
+    def _run(self, job_id, attempt):
+        Job = job_model()
+        session = self.make_session()
+        try:
+            job = session.query(
+                Job.name, Job.payload, Job.created, Job.max_attempts
+            ).filter(Job.id == job_id).one()
+            if attempt == 1:
+                metrics.JOB_WAIT_SECONDS.observe(
+                    (datetime.datetime.utcnow() - job.created)
+                    .total_seconds(), job=job.name)
+            start = time.time()
+            try:
+                func = HANDLERS.get(job.name)
+                if func is None:
+                    raise LookupError('no handler for {!r} jobs'.format(
+                        job.name))
+                func(session, **json.loads(job.payload))
+                outcome = finish(session, job_id, attempt)
+                if outcome == 'lost':
+                    session.rollback()
+                else:
+                    session.commit()
+            except Exception:
+                session.rollback()
+                log.exception('job %s (%s) failed on attempt %s',
+                              job_id, job.name, attempt)
+                outcome = finish(session, job_id, attempt,
+                                 as_text(traceback.format_exc()),
+                                 job.max_attempts)
+                session.commit()
+            metrics.JOB_SECONDS.observe(time.time() - start, job=job.name)
+            metrics.JOBS.inc(job=job.name, outcome=outcome)
+            return outcome
+        finally:
+            session.close()
+
+    def run_pending(self):
+        """Run due jobs here and now, until none are left; returns how many"""
+        count = 0
+        while True:
+            claimed = self.claim(1)
+            if not claimed:
+                return count
+            self.run(*claimed[0])
+            count += 1
+
+    def start(self):
+        if not self.threads or self._thread is not None:
+            return
+        self._pool = workers.ThreadPool(self.threads, self.threads,
+                                        name='job')
+        self._thread = threading.Thread(target=self._dispatch,
+                                        name='job-dispatch')
+        self._thread.daemon = True
+        self._thread.start()
+        _runners.append(self)
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        """Stop claiming jobs, and wait for the ones running to finish"""
+        if self._thread is None:
+            return
+        _runners.remove(self)
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join()
+        self._pool.shutdown()
+        self._thread = self._pool = None
+
+    def _done(self, job_id, attempt):
+        try:
+            self.run(job_id, attempt)
+        finally:
+            with self._lock:
+                self.running -= 1
+            self._wake.set()
+
+    def _dispatch(self):
+        while not self._stopping.is_set():
+            # cleared before looking, so a wake-up while claiming counts
+            self._wake.clear()
+            if self.pruned is None or \
+                    time.time() - self.pruned >= PRUNE_SECONDS:
+                try:
+                    self.prune()
+                except Exception:
+                    self.pruned = time.time()
+                    log.exception('could not prune done jobs')
+            with self._lock:
+                free = self.threads - self.running
+            claimed = []
+            if free:
+                try:
+                    claimed = self.claim(free)
+                except Exception:
+                    log.exception('could not claim jobs')
+            for job_id, attempt in claimed:
+                with self._lock:
+                    self.running += 1
+                self._pool.submit(self._done, job_id, attempt)
+            if len(claimed) < free or not free:
+                self._wake.wait(self.poll_seconds)
+
+
+def queue_collector(engine):
+    """Expose the queue's size by state, and its oldest due job's wait"""
+    Job = job_model()
+
+    def collect():
+        now = datetime.datetime.utcnow()
+        try:
+            with engine.connect() as conn:
+                rows = conn.execute(sa.select([
+                    Job.state, sa.func.count(Job.id), sa.func.min(Job.run_at)
+                ]).where(
+                    Job.state.in_((QUEUED, RUNNING, FAILED))
+                ).group_by(Job.state)).fetchall()
+        except sa.exc.DBAPIError:
+            log.exception('could not count jobs')
+            return
+        states = dict((row[0], row[1:]) for row in rows)
+        yield '# HELP journal_jobs Jobs in the queue, by state'
+        yield '# TYPE journal_jobs gauge'
+        for state in (QUEUED, RUNNING, FAILED):
+            yield 'journal_jobs{{state="{}"}} {}'.format(
+                state, states.get(state, (0,))[0])
+        oldest = states.get(QUEUED, (0, None))[1]
+        waited = max((now - oldest).total_seconds(), 0) if oldest else 0
+        yield '# HELP journal_jobs_oldest_due_seconds How long the ' \
+            'longest waiting due job has waited'
+        yield '# TYPE journal_jobs_oldest_due_seconds gauge'
+        yield 'journal_jobs_oldest_due_seconds {}'.format(waited)
+
+    return collect
+
+
+def includeme(config):
+    import journal
+    settings = config.get_settings()
+    # started by whatever serves the app, see server.py
+    config.registry.job_runner = Runner(
+        journal.engine,
+        threads=int(settings.get('jobs.threads', THREADS)),
+        poll_seconds=float(settings.get('jobs.poll_seconds', POLL_SECONDS)),
+        lease_seconds=int(settings.get('jobs.lease_seconds', LEASE_SECONDS)),
+        keep_seconds=int(settings.get('jobs.keep_seconds', KEEP_SECONDS)),
+    )
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Maintenance commands for the learning journal
+
+Run `python manage.py --help` for the list of commands.
+"""
+from __future__ import unicode_literals, print_function
+import argparse
+import io
+import signal
+import sys
+import threading
+import transaction
+
+import assets
+import bulk
+import dbpool
+
+import journal
+import jobs
+import metrics
+import migrations
+import sitegen
+
+
+def bind():
+    """Bind the journal session to the configured database"""
+    journal.DBSession.configure(bind=journal.engine)
+    return journal.DBSession
+
+
+def render(args):
+    """Fill in (or refresh) the stored HTML of entries"""
+    session = bind()
+    with dbpool.writing(), transaction.manager:
+        count = journal.Entry.render_all(
+            force=args.all, batch_size=args.batch_size, session=session
+        )
+    print('rendered {} entries (renderer version {})'.format(
+        count, journal.RENDERER_VERSION))
+
+
+def migrate(args):
+    """Create the database, or bring its schema up to date"""
+    with journal.engine.connect() as conn:
+        version = migrations.current_version(conn)
+    if args.status:
+        print('database is at version {}, code expects version {}'.format(
+            version, migrations.head()))
+        return
+    if version == 0:
+        journal.init_db()
+        print('created database at version {}'.format(migrations.head()))
+        return
+    applied = migrations.upgrade(journal.engine, log=print)
+    if not applied:
+        print('database is already at version {}'.format(version))
+
+
+def import_entries(args):
+    """Bulk load entries from JSON lines or Markdown files"""
+    count = bulk.import_entries(
+        journal.engine, args.sources, file_format=args.format,
+        batch_size=args.batch_size, progress_path=args.progress,
+        resume=args.resume, log=print
+    )
+    print('imported {} entries'.format(count))
+
+
+def export_entries(args):
+    """Stream every entry out as JSON lines or Markdown files"""
+    session = bind()
+    with transaction.manager:
+        if args.format == 'markdown':
+            count = bulk.export_markdown(session, args.output, args.batch_size)
+        elif args.output == '-':
+            out = io.open(sys.stdout.fileno(), 'w', encoding='utf-8',
+                          closefd=False)
+            count = bulk.export_jsonl(session, out, args.batch_size)
+            out.flush()
+        else:
+            with io.open(args.output, 'w', encoding='utf-8') as out:
+                count = bulk.export_jsonl(session, out, args.batch_size)
+    print('exported {} entries'.format(count), file=sys.stderr)
+
+
+def build_assets(args):
+    """Fingerprint and precompress static/ and the generated assets"""
+    manifest = assets.build(
+        journal.STATIC_DIR, args.output, journal.generated_assets())
+    print('built {} assets into {}'.format(len(manifest), args.output))
+
+
+def compile_templates(args):
+    """Compile the Jinja2 templates into the bytecode cache"""
+    from pyramid.config import Configurator
+    config = Configurator(settings=journal.template_settings({}))
+    config.include('pyramid_jinja2')
+    config.commit()
+    names = journal.precompile_templates(config.get_jinja2_environment())
+    print('compiled {} templates into {}'.format(
+        len(names), journal.TEMPLATE_CACHE_DIR))
+
+
+def export_site(args):
+    """Render the journal to a directory of static HTML"""
+    session = bind()
+    registry = journal.main().registry
+    with transaction.manager:
+        done = sitegen.export(
+            registry, session, args.output, processes=args.processes,
+            chunk_size=args.chunk_size, full=args.full, log=print
+        )
+    print('rendered {entries} entries ({removed} removed), {pages_written} '
+          'of {pages} listing pages and {assets} new assets'.format(**done))
+
+
+def run_jobs(args):
+    """Run background jobs from the queue until stopped"""
+    if args.requeue_failed:
+        with journal.engine.begin() as conn:
+            count = jobs.requeue_failed(conn)
+        print('requeued {} failed jobs'.format(count))
+    runner = jobs.Runner(
+        journal.engine, threads=args.threads, poll_seconds=args.poll_seconds,
+        lease_seconds=args.lease_seconds, keep_seconds=args.keep_seconds
+    )
+    if args.once:
+        print('ran {} jobs'.format(runner.run_pending()))
+        print('deleted {} old done jobs'.format(runner.prune()))
+        return
+    if args.metrics_port:
+        metrics.registry.collectors['jobs'] = jobs.queue_collector(
+            journal.engine)
+        metrics.serve(args.metrics_port)
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    runner.start()
+    # wait with a timeout, or signals aren't handled until it's over
+    while not stopping.is_set():
+        stopping.wait(1)
+    print('finishing the jobs under way', file=sys.stderr)
+    runner.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command')
+
+    cmd = commands.add_parser(
+        'render', help='backfill stored HTML for new or out of date entries'
+    )
+    cmd.add_argument(
+        '--all', action='store_true',
+        help='re-render every entry, e.g. after changing the markdown config'
+    )
+    cmd.add_argument('--batch-size', type=int, default=100)
+    cmd.set_defaults(func=render)
+
+    cmd = commands.add_parser(
+        'migrate',
+        help='create the database or migrate it to the latest schema'
+    )
+    cmd.add_argument(
+        '--status', action='store_true',
+        help="only show the database's schema version"
+    )
+    cmd.set_defaults(func=migrate)
+
+    cmd = commands.add_parser('import', help=import_entries.__doc__.lower())
+    cmd.add_argument('sources', nargs='+', metavar='SOURCE',
+                     help='a .jsonl file, or a .md file or directory of them')
+    cmd.add_argument('--format', choices=sorted(bulk.READERS),
+                     default='jsonl')
+    cmd.add_argument('--batch-size', type=int, default=bulk.BATCH_SIZE)
+    cmd.add_argument('--progress', default='.import-progress.json',
+                     help='where to record how far each source has got')
+    cmd.add_argument('--resume', action='store_true',
+                     help='skip what the progress file says is done already')
+    cmd.set_defaults(func=import_entries)
+
+    cmd = commands.add_parser('export', help=export_entries.__doc__.lower())
+    cmd.add_argument('output', nargs='?', default='-',
+                     help='file (or directory, for markdown); - for stdout')
+    cmd.add_argument('--format', choices=sorted(bulk.READERS),
+                     default='jsonl')
+    cmd.add_argument('--batch-size', type=int, default=bulk.BATCH_SIZE)
+    cmd.set_defaults(func=export_entries)
+
+    cmd = commands.add_parser('assets', help=build_assets.__doc__.lower())
+    cmd.add_argument('--output', default=journal.ASSETS_DIR)
+    cmd.set_defaults(func=build_assets)
+
+    cmd = commands.add_parser('site', help=export_site.__doc__.lower())
+    cmd.add_argument('output', help='directory to write the site into')
+    cmd.add_argument('--processes', type=int,
+                     help='worker processes (default: one per CPU)')
+    cmd.add_argument('--chunk-size', type=int, default=sitegen.CHUNK_SIZE,
+                     help='entries per job handed to a worker')
+    cmd.add_argument('--full', action='store_true',
+                     help='render every entry, not just the changed ones')
+    cmd.set_defaults(func=export_site)
+
+    cmd = commands.add_parser('jobs', help=run_jobs.__doc__.lower())
+    cmd.add_argument('--threads', type=int, default=jobs.THREADS)
+    cmd.add_argument('--poll-seconds', type=float, default=jobs.POLL_SECONDS,
+                     help='how often to look for jobs queued elsewhere')
+    cmd.add_argument('--lease-seconds', type=int, default=jobs.LEASE_SECONDS,
+                     help='how long a job may run before another worker '
+                     'may take it over')
+    cmd.add_argument('--keep-seconds', type=int, default=jobs.KEEP_SECONDS,
+                     help='how long to keep jobs that are done')
+    cmd.add_argument('--once', action='store_true',
+                     help='run the jobs that are due, then exit')
+    cmd.add_argument('--requeue-failed', action='store_true',
+                     help='first give failed jobs another set of attempts')
+    cmd.add_argument('--metrics-port', type=int,
+                     help='serve /metrics on this port')
+    cmd.set_defaults(func=run_jobs)
+
+    cmd = commands.add_parser('templates',
+                              help=compile_templates.__doc__.lower())
+    cmd.set_defaults(func=compile_templates)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
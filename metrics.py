@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""In-process request metrics, served in Prometheus text format
+
+A tween times every request and, through SQLAlchemy engine events and a
+timed Jinja2 template class, how much of that went to SQL and to
+template rendering. Markdown rendering and bcrypt checks are timed
+where they happen with `timer`. Everything is aggregated into histograms
+and counters in this process and served from /metrics.
+
+Setting SLOW_REQUEST_MS logs every request slower than that, with the SQL
+it ran, to the `journal.slow` logger.
+"""
+from __future__ import unicode_literals
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+import jinja2
+from pyramid.response import Response
+from pyramid.tweens import INGRESS
+from pyramid_jinja2 import EXTRAS_CONFIG_PHASE
+import sqlalchemy as sa
+
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+log = logging.getLogger('journal.slow')
+current = threading.local()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name, '{}'.format(value).replace('\\', r'\\').replace('"', r'\"')
+        ) for name, value in labels
+    ))
+
+
+class Counter(object):
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def expose(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} counter'.format(self.name)
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '{}{} {}'.format(self.name, format_labels(key), value)
+
+
+class Histogram(object):
+    def __init__(self, name, help_text, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def count(self, **labels):
+        series = self._series.get(tuple(sorted(labels.items())))
+        return series[1] if series else 0
+
+    def expose(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} histogram'.format(self.name)
+        with self._lock:
+            series = sorted(
+                (key, (list(b), c, s)) for key, (b, c, s)
+                in self._series.items()
+            )
+        for key, (buckets, count, total) in series:
+            cumulative = 0
+            for bound, hits in zip(self.buckets, buckets):
+                cumulative += hits
+                yield '{}_bucket{} {}'.format(
+                    self.name, format_labels(key + (('le', bound),)),
+                    cumulative
+                )
+            yield '{}_bucket{} {}'.format(
+                self.name, format_labels(key + (('le', '+Inf'),)), count
+            )
+            yield '{}_count{} {}'.format(self.name, format_labels(key), count)
+            yield '{}_sum{} {}'.format(self.name, format_labels(key), total)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = {}
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for name, collector in sorted(self.collectors.items()):
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.add(Counter(
+    'journal_requests_total', 'Requests handled, by route and status'))
+REQUEST_SECONDS = registry.add(Histogram(
+    'journal_request_duration_seconds', 'Time to handle a request'))
+SQL_QUERIES = registry.add(Histogram(
+    'journal_sql_queries_per_request', 'SQL statements run per request',
+    COUNT_BUCKETS))
+SQL_SECONDS = registry.add(Histogram(
+    'journal_sql_duration_seconds', 'Time spent in SQL per request'))
+TEMPLATE_SECONDS = registry.add(Histogram(
+    'journal_template_render_seconds', 'Time spent rendering templates'))
+RENDER_SECONDS = registry.add(Histogram(
+    'journal_render_seconds',
+    'Time spent in slow operations (markdown, bcrypt), by kind'))
+PAGE_CACHE = registry.add(Counter(
+    'journal_page_cache_total', 'Page cache lookups, by result'))
+DB_READS = registry.add(Counter(
+    'journal_db_reads_total',
+    'Requests by the database they read from, when there are replicas'))
+SHED = registry.add(Counter(
+    'journal_requests_shed_total',
+    'Requests turned away with 503 because the server was too busy'))
+JOBS = registry.add(Counter(
+    'journal_jobs_run_total',
+    'Background job attempts run by this process, by job and outcome'))
+JOB_WAIT_SECONDS = registry.add(Histogram(
+    'journal_job_wait_seconds',
+    'Time from queueing a job to its first attempt starting, by job',
+    DURATION_BUCKETS + (30.0, 60.0, 300.0)))
+JOB_SECONDS = registry.add(Histogram(
+    'journal_job_duration_seconds', 'Time spent running jobs, by job'))
+
+
+class RequestStats(object):
+    """What one request spent its time on"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.queries = []
+        self.template_seconds = 0.0
+        self.timings = {}
+
+
+@contextlib.contextmanager
+def timer(kind):
+    """Time a block as `kind`, both overall and for the current request"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        RENDER_SECONDS.observe(elapsed, kind=kind)
+        stats = getattr(current, 'stats', None)
+        if stats is not None:
+            stats.timings[kind] = stats.timings.get(kind, 0.0) + elapsed
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.time() - conn.info['query_start'].pop()
+    stats = getattr(current, 'stats', None)
+    if stats is None:
+        return
+    stats.sql_count += 1
+    stats.sql_seconds += elapsed
+    if current.keep_queries:
+        stats.queries.append((elapsed, statement))
+
+
+def handle_error(context):
+    # a statement that fails never gets to after_cursor_execute
+    conn = context.connection
+    if conn is not None and context.execution_context is not None and \
+            conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+class TimedTemplate(jinja2.Template):
+    """A Jinja2 template that adds its render time to the request's"""
+
+    def render(self, *args, **kw):
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kw)
+        finally:
+            stats = getattr(current, 'stats', None)
+            if stats is not None:
+                stats.template_seconds += time.time() - start
+
+
+def tween_factory(handler, registry):
+    settings = registry.settings
+    slow = settings.get('metrics.slow_request_ms')
+    slow = float(slow) / 1000 if slow else None
+
+    def metrics_tween(request):
+        stats = current.stats = RequestStats()
+        current.keep_queries = slow is not None
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_int
+            cache = response.headers.get('X-Cache')
+            if cache:
+                PAGE_CACHE.inc(result=cache.lower())
+            return response
+        finally:
+            current.stats = None
+            elapsed = time.time() - stats.start
+            route = request.matched_route
+            route = route.name if route is not None else 'unmatched'
+            REQUESTS.inc(route=route, status=status)
+            REQUEST_SECONDS.observe(elapsed, route=route)
+            SQL_QUERIES.observe(stats.sql_count, route=route)
+            SQL_SECONDS.observe(stats.sql_seconds, route=route)
+            if stats.template_seconds:
+                TEMPLATE_SECONDS.observe(stats.template_seconds, route=route)
+            if slow is not None and elapsed >= slow:
+                log_slow(request, route, elapsed, stats)
+
+    return metrics_tween
+
+
+def log_slow(request, route, elapsed, stats):
+    lines = [
+        'slow request: {} {} ({}) took {:.1f}ms: {} queries in {:.1f}ms, '
+        'templates {:.1f}ms{}'.format(
+            request.method, request.path_qs, route, elapsed * 1000,
+            stats.sql_count, stats.sql_seconds * 1000,
+            stats.template_seconds * 1000,
+            ''.join(', {} {:.1f}ms'.format(kind, seconds * 1000)
+                    for kind, seconds in sorted(stats.timings.items()))
+        )
+    ]
+    for seconds, statement in stats.queries:
+        lines.append('  {:8.1f}ms  {}'.format(
+            seconds * 1000, ' '.join(statement.split())))
+    log.warning('\n'.join(lines))
+
+
+def pool_collector(engine):
+    """Expose dbpool's statistics for `engine` as gauges and a histogram"""
+    import dbpool
+
+    def collect():
+        stats = dbpool.pool_stats(engine)
+        for name in ('size', 'checked_out', 'overflow'):
+            if name in stats:
+                yield '# TYPE journal_db_pool_{} gauge'.format(name)
+                yield 'journal_db_pool_{} {}'.format(name, stats[name])
+        for name in ('checkouts', 'overflows', 'timeouts'):
+            if name in stats:
+                yield '# TYPE journal_db_pool_{}_total counter'.format(name)
+                yield 'journal_db_pool_{}_total {}'.format(name, stats[name])
+        if 'wait_buckets' in stats:
+            name = 'journal_db_pool_wait_seconds'
+            yield '# TYPE {} histogram'.format(name)
+            cumulative = 0
+            for bound, hits in stats['wait_buckets']:
+                cumulative += hits
+                yield '{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative)
+            yield '{}_count {}'.format(name, cumulative)
+            yield '{}_sum {}'.format(name, stats['wait_sum'])
+
+    return collect
+
+
+def serve(port, host='0.0.0.0'):
+    """Serve the metrics from a thread, in processes without the app"""
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def app(environ, start_response):
+        start_response(str('200 OK'), [
+            (str('Content-Type'), str('text/plain; charset=utf-8'))])
+        return [registry.expose().encode('utf-8')]
+
+    server = make_server(host, port, app, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def metrics_view(request):
+    return Response(
+        registry.expose(), content_type=str('text/plain'), charset=str('utf-8')
+    )
+
+
+_listening = []
+
+
+def includeme(config):
+    if not _listening:
+        sa.event.listen(
+            sa.engine.Engine, 'before_cursor_execute', before_cursor_execute)
+        sa.event.listen(
+            sa.engine.Engine, 'after_cursor_execute', after_cursor_execute)
+        sa.event.listen(sa.engine.Engine, 'handle_error', handle_error)
+        _listening.append(True)
+
+    def time_templates():
+        config.get_jinja2_environment().template_class = TimedTemplate
+    config.action(None, time_templates, order=EXTRAS_CONFIG_PHASE)
+
+    config.add_tween('metrics.tween_factory', under=INGRESS)
+    config.add_route('metrics', '/metrics')
+    config.add_view(metrics_view, route_name='metrics')
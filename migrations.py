@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Versioned schema migrations for the learning journal database
+
+Each migration moves the schema up by one version and is applied in its
+own transaction. The version a database is at is kept in the one-row
+`schema_version` table. Databases created before migrations existed have
+no such table and are treated as being at version 1.
+
+Migrations describe the columns they touch themselves rather than reading
+them off the model, so that they keep doing the same thing as the model
+moves on.
+"""
+from __future__ import unicode_literals
+import datetime
+import sqlalchemy as sa
+
+import archive
+import search
+
+
+metadata = sa.MetaData()
+schema_version = sa.Table(
+    'schema_version', metadata,
+    sa.Column('version', sa.Integer, nullable=False),
+    sa.Column('applied', sa.DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+class SchemaOutOfDate(RuntimeError):
+    """The database needs migrating before the app can use it"""
+
+
+def migration(func):
+    """Register a migration; they are numbered in definition order"""
+    MIGRATIONS.append(func)
+    return func
+
+
+def baseline_entries(meta=None):
+    """The entries table as it was before migrations"""
+    return sa.Table(
+        'entries', meta if meta is not None else sa.MetaData(),
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('title', sa.Unicode(127), nullable=False),
+        sa.Column('date', sa.DateTime, nullable=False),
+        sa.Column('content', sa.UnicodeText, nullable=False),
+    )
+
+
+def add_column(conn, table, column):
+    """ALTER TABLE ... ADD COLUMN
+
+    The column has to be nullable or have a server default, for the rows
+    that are already there.
+    """
+    conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+        table, sa.schema.CreateColumn(column).compile(dialect=conn.dialect)
+    ))
+
+
+@migration
+def create_entries(conn):
+    """Create the entries table"""
+    baseline_entries().create(conn, checkfirst=True)
+
+
+@migration
+def add_rendered_html(conn):
+    """Store rendered HTML alongside the markdown source"""
+    add_column(conn, 'entries', sa.Column('content_html', sa.UnicodeText))
+    add_column(conn, 'entries', sa.Column('content_hash', sa.String(40)))
+    add_column(conn, 'entries', sa.Column('renderer_version', sa.Integer))
+
+
+@migration
+def index_entries_by_date(conn):
+    """Index the listing order so the home page doesn't sort the table"""
+    entries = baseline_entries()
+    sa.Index(
+        'ix_entries_date_id', entries.c.date.desc(), entries.c.id.desc()
+    ).create(conn)
+
+
+@migration
+def add_updated_at(conn):
+    """Track when entries last changed, for conditional GETs"""
+    add_column(conn, 'entries', sa.Column('updated_at', sa.DateTime))
+    conn.execute('UPDATE entries SET updated_at = date')
+
+
+@migration
+def add_search_index(conn):
+    """Full-text index entries (tsvector + GIN, or SQLite FTS5)"""
+    search.install(conn)
+
+
+@migration
+def add_version(conn):
+    """Count changes to entries, for optimistic concurrency in the API"""
+    add_column(conn, 'entries', sa.Column(
+        'version', sa.Integer, nullable=False, server_default='1'
+    ))
+
+
+@migration
+def add_entry_months(conn):
+    """Count entries per month in a summary table, kept by triggers"""
+    sa.Table(
+        'entry_months', sa.MetaData(),
+        sa.Column('year', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('month', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('count', sa.Integer, nullable=False),
+    ).create(conn)
+    archive.install(conn)
+
+
+@migration
+def add_entry_revisions(conn):
+    """Keep every version of entries, as compressed deltas"""
+    meta = sa.MetaData()
+    baseline_entries(meta)
+    sa.Table(
+        'entry_revisions', meta,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('entry_id', sa.Integer, sa.ForeignKey(
+            'entries.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('number', sa.Integer, nullable=False),
+        sa.Column('snapshot', sa.Boolean, nullable=False),
+        sa.Column('title', sa.Unicode(127), nullable=False),
+        sa.Column('created', sa.DateTime, nullable=False),
+        sa.Column('data', sa.LargeBinary, nullable=False),
+        sa.UniqueConstraint('entry_id', 'number'),
+    ).create(conn)
+
+
+@migration
+def add_jobs(conn):
+    """Queue background jobs in a table"""
+    jobs = sa.Table(
+        'jobs', sa.MetaData(),
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('name', sa.String(64), nullable=False),
+        sa.Column('idempotency_key', sa.String(255), unique=True),
+        sa.Column('payload', sa.UnicodeText, nullable=False),
+        sa.Column('state', sa.String(16), nullable=False),
+        sa.Column('attempts', sa.Integer, nullable=False),
+        sa.Column('max_attempts', sa.Integer, nullable=False),
+        sa.Column('run_at', sa.DateTime, nullable=False),
+        sa.Column('created', sa.DateTime, nullable=False),
+        sa.Column('finished', sa.DateTime),
+        sa.Column('error', sa.UnicodeText),
+    )
+    jobs.create(conn)
+    sa.Index('ix_jobs_state_run_at', jobs.c.state, jobs.c.run_at).create(conn)
+
+
+@migration
+def index_entries_by_update(conn):
+    """Index updated_at, so listing ETags find the latest change cheaply"""
+    entries = sa.Table(
+        'entries', sa.MetaData(), sa.Column('updated_at', sa.DateTime))
+    sa.Index('ix_entries_updated_at', entries.c.updated_at).create(conn)
+
+
+def head():
+    """The version the code expects the database to be at"""
+    return len(MIGRATIONS)
+
+
+def current_version(conn):
+    """The version the database is at; 0 for an empty database"""
+    if not conn.dialect.has_table(conn, 'schema_version'):
+        if conn.dialect.has_table(conn, 'entries'):
+            return 1
+        return 0
+    return conn.execute(
+        sa.select([sa.func.max(schema_version.c.version)])
+    ).scalar() or 0
+
+
+def stamp(conn, version):
+    """Record that the database is at `version`"""
+    schema_version.create(conn, checkfirst=True)
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(
+        version=version, applied=datetime.datetime.utcnow()
+    ))
+
+
+def create(engine, metadata):
+    """Create a brand new database straight from the model at head"""
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        stamp(conn, head())
+
+
+def upgrade(engine, target=None, log=None):
+    """Apply pending migrations up to `target` (default: all of them)
+
+    Returns the list of versions that were applied.
+    """
+    if target is None:
+        target = head()
+    applied = []
+    with engine.connect() as conn:
+        version = current_version(conn)
+    for number in range(version + 1, target + 1):
+        func = MIGRATIONS[number - 1]
+        if log is not None:
+            log('{:>3} {}'.format(number, func.__doc__))
+        with engine.begin() as conn:
+            func(conn)
+            stamp(conn, number)
+        applied.append(number)
+    return applied
+
+
+def check(engine):
+    """Refuse to go on if the database is behind (or ahead of) the code"""
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if version != head():
+        raise SchemaOutOfDate(
+            'database schema is at version {}, this code needs version {}; '
+            'run `python manage.py migrate`'.format(version, head())
+        )
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""A rendered-page cache for anonymous readers
+
+Anonymous GETs of cacheable pages are answered straight from the cache by
+a tween, before a transaction is started or the database is touched.
+Views opt a page in by adding tags to `request.cache_tags`, and writes
+evict every page carrying one of the tags they change once their
+transaction commits.
+
+Backends are picked with the PAGE_CACHE environment variable:
+
+    memory          an LRU in this process (the default)
+    sqlite:<path>   a SQLite file shared by every process on the machine
+    off             no caching
+
+A memory cache only hears of the writes its own process makes, so it is
+for single-process servers; server.py switches its workers to a shared
+SQLite file when it forks more than one.
+"""
+from __future__ import unicode_literals
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from pyramid.response import Response
+import transaction
+
+
+MAX_ENTRIES = 1000
+TTL = 300
+
+
+class MemoryBackend(object):
+    """A thread-safe LRU of pages, bounded by count and age"""
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.pop(key, None)
+            if page is None:
+                return None
+            expires, tags, value = page
+            if expires < time.time():
+                return None
+            self._pages[key] = page
+            return value
+
+    def set(self, key, value, tags):
+        with self._lock:
+            self._pages.pop(key, None)
+            self._pages[key] = (time.time() + self.ttl, frozenset(tags), value)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def invalidate(self, tags):
+        tags = frozenset(tags)
+        with self._lock:
+            for key, (_, page_tags, _) in list(self._pages.items()):
+                if page_tags & tags:
+                    del self._pages[key]
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+class SQLiteBackend(object):
+    """Pages kept in a SQLite file, so that worker processes share them"""
+
+    def __init__(self, path, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                ' key TEXT PRIMARY KEY, expires REAL, accessed REAL,'
+                ' value TEXT, body BLOB)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS page_tags ('
+                ' tag TEXT, key TEXT, PRIMARY KEY (tag, key))'
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            'SELECT expires, value, body FROM pages WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[0] < now:
+            return None
+        with conn:
+            conn.execute(
+                'UPDATE pages SET accessed = ? WHERE key = ?', (now, key)
+            )
+        status, headerlist = json.loads(row[1])
+        return (
+            str(status),
+            [(str(name), str(value)) for name, value in headerlist],
+            bytes(row[2])
+        )
+
+    def set(self, key, value, tags):
+        status, headerlist, body = value
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                (key, now + self.ttl, now,
+                 json.dumps([status, headerlist]), sqlite3.Binary(body))
+            )
+            conn.execute('DELETE FROM page_tags WHERE key = ?', (key,))
+            conn.executemany(
+                'INSERT INTO page_tags VALUES (?, ?)',
+                [(tag, key) for tag in tags]
+            )
+            conn.execute(
+                'DELETE FROM pages WHERE key IN (SELECT key FROM pages'
+                ' ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            conn.execute(
+                'DELETE FROM page_tags'
+                ' WHERE key NOT IN (SELECT key FROM pages)'
+            )
+
+    def invalidate(self, tags):
+        tags = list(tags)
+        marks = ', '.join('?' * len(tags))
+        with self._connect() as conn:
+            conn.execute(
+                'DELETE FROM pages WHERE key IN (SELECT key FROM page_tags'
+                ' WHERE tag IN ({}))'.format(marks), tags
+            )
+            conn.execute(
+                'DELETE FROM page_tags WHERE tag IN ({})'.format(marks), tags
+            )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM pages')
+            conn.execute('DELETE FROM page_tags')
+
+
+def from_settings(settings):
+    """Build the configured backend, or None if caching is off"""
+    backend = settings.get('page_cache.backend', 'memory')
+    max_entries = int(settings.get('page_cache.max_entries', MAX_ENTRIES))
+    ttl = float(settings.get('page_cache.ttl', TTL))
+    if backend == 'off':
+        return None
+    if backend == 'memory':
+        return MemoryBackend(max_entries, ttl)
+    if backend.startswith('sqlite:'):
+        return SQLiteBackend(backend[len('sqlite:'):], max_entries, ttl)
+    raise ValueError('unknown page cache backend: {}'.format(backend))
+
+
+def settings_from_environ(settings):
+    """Copy the PAGE_CACHE* environment variables into app settings"""
+    settings['page_cache.backend'] = os.environ.get('PAGE_CACHE', 'memory')
+    settings['page_cache.max_entries'] = os.environ.get(
+        'PAGE_CACHE_SIZE', MAX_ENTRIES
+    )
+    settings['page_cache.ttl'] = os.environ.get('PAGE_CACHE_TTL', TTL)
+
+
+def cache_tags(request):
+    """The tags of the page being rendered; views add to it to be cached"""
+    return set()
+
+
+def tween_factory(handler, registry):
+    cache = getattr(registry, 'page_cache', None)
+    if cache is None:
+        return handler
+
+    def page_cache_tween(request):
+        if request.method != 'GET' or request.authenticated_userid:
+            return handler(request)
+        key = request.url
+        page = cache.get(key)
+        if page is not None:
+            status, headerlist, body = page
+            response = Response(
+                body=body, status=status, headerlist=list(headerlist)
+            )
+            response.headers[str('X-Cache')] = str('HIT')
+            response.conditional_response = True
+            return response
+        response = handler(request)
+        if (
+            response.status_int == 200 and request.cache_tags and
+            'Set-Cookie' not in response.headers
+        ):
+            cache.set(
+                key,
+                (response.status, list(response.headerlist), response.body),
+                request.cache_tags
+            )
+            response.headers[str('X-Cache')] = str('MISS')
+        return response
+
+    return page_cache_tween
+
+
+def invalidate_on_commit(event):
+    """Evict the pages showing changed entries once the write commits"""
+    cache = getattr(event.request.registry, 'page_cache', None)
+    if cache is None:
+        return
+    tags = ['listing'] + ['entry:{}'.format(i) for i in event.entry_ids]
+
+    def evict(success):
+        if success:
+            cache.invalidate(tags)
+
+    transaction.get().addAfterCommitHook(evict)
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.page_cache = from_settings(settings)
+    config.add_request_method(cache_tags, reify=True)
+    config.add_tween(
+        'pagecache.tween_factory', over='pyramid_tm.tm_tween_factory'
+    )
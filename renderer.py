@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Markdown rendering with reusable pipelines
+
+`markdown.markdown()` builds a new Markdown instance for every call. That
+means resolving the extensions by name and building every preprocessor,
+pattern and treeprocessor again. Here each thread keeps one instance per
+highlighting mode and resets it between documents.
+
+codehilite also looks up its Pygments lexer by name for every code block,
+scanning Pygments' lexer table and, for names it doesn't know, the
+installed plugins. Lexers carry no per-document state, so they are looked
+up once per language and shared.
+"""
+from __future__ import unicode_literals
+import threading
+
+import markdown
+from markdown.extensions import codehilite
+from pygments.lexers import get_lexer_by_name as find_lexer
+from pygments.util import ClassNotFound
+
+import highlight
+
+
+EXTENSIONS = ['markdown.extensions.codehilite']
+
+_lexers = {}
+_lexers_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_lexer_by_name(alias, **options):
+    """Pygments' get_lexer_by_name, remembering what each alias gave"""
+    if options:
+        return find_lexer(alias, **options)
+    try:
+        lexer = _lexers[alias]
+    except KeyError:
+        try:
+            lexer = find_lexer(alias)
+        except ClassNotFound:
+            lexer = None
+        with _lexers_lock:
+            lexer = _lexers.setdefault(alias, lexer)
+    if lexer is None:
+        raise ClassNotFound('no lexer for alias {!r} found'.format(alias))
+    return lexer
+
+
+codehilite.get_lexer_by_name = get_lexer_by_name
+
+
+def make_markdown(mode):
+    return markdown.Markdown(
+        extensions=EXTENSIONS,
+        extension_configs=highlight.markdown_config(mode)
+    )
+
+
+def get_markdown(mode):
+    """This thread's Markdown instance for a highlighting mode"""
+    instances = getattr(_local, 'instances', None)
+    if instances is None:
+        instances = _local.instances = {}
+    md = instances.get(mode)
+    if md is None:
+        md = instances[mode] = make_markdown(mode)
+    return md
+
+
+def render(text, mode):
+    """Turn markdown source into highlighted HTML"""
+    md = get_markdown(mode)
+    try:
+        html = md.convert(text)
+    finally:
+        md.reset()
+    if mode == 'classes':
+        html = highlight.strip_unstyled(html)
+    return html
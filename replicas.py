@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Send reads to replica databases, and writes to the primary
+
+With REPLICA_URLS set (a comma separated list of database URLs), GET and
+HEAD requests read from one of the replicas, taken in turn, and every
+other request, and anything that has to flush, uses the primary.
+
+Replicas lag behind the primary a little. So that people see what they
+have just written, a request that changed something gets a cookie that
+keeps that browser's reads on the primary for REPLICA_STICKY_SECONDS
+(5 by default). For the same window after any write this process
+handles, every read goes to the primary, so that pages the page cache
+has just evicted aren't rendered again, and cached, from a replica that
+hasn't caught up.
+"""
+from __future__ import unicode_literals
+import itertools
+import threading
+import time
+
+from pyramid.tweens import EXCVIEW
+from sqlalchemy.orm import Session
+
+import metrics
+
+
+STICKY_SECONDS = 5
+COOKIE = 'read_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_local = threading.local()
+
+
+def replica():
+    """The replica engine this thread's requests read from, if any"""
+    return getattr(_local, 'engine', None)
+
+
+class RoutingSession(Session):
+    """A session that reads from the current request's replica"""
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = replica()
+        if engine is not None and not self._flushing:
+            return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class Router(object):
+    """Picks the database each request reads from"""
+
+    def __init__(self, engines, sticky_seconds=STICKY_SECONDS):
+        self.engines = list(engines)
+        self.sticky_seconds = sticky_seconds
+        self.last_write = 0.0
+        self._turn = itertools.cycle(self.engines)
+        self._lock = threading.Lock()
+
+    def choose(self, request):
+        """A replica engine for the request, or None for the primary"""
+        if not self.engines or request.method not in SAFE_METHODS:
+            return None
+        now = time.time()
+        if now < self.last_write + self.sticky_seconds:
+            return None
+        try:
+            until = float(request.cookies.get(COOKIE, 0))
+        except ValueError:
+            until = 0
+        if now < until:
+            return None
+        with self._lock:
+            return next(self._turn)
+
+    def wrote(self, response):
+        """Keep this process, and the client, on the primary for a while"""
+        now = time.time()
+        self.last_write = now
+        response.set_cookie(
+            str(COOKIE), str('{:.3f}'.format(now + self.sticky_seconds)),
+            max_age=self.sticky_seconds, httponly=True
+        )
+
+
+def tween_factory(handler, registry):
+    router = registry.replicas
+    if not router.engines:
+        return handler
+
+    def replica_tween(request):
+        engine = router.choose(request)
+        metrics.DB_READS.inc(
+            database='primary' if engine is None else 'replica')
+        _local.engine = engine
+        try:
+            response = handler(request)
+        finally:
+            _local.engine = None
+        if request.method not in SAFE_METHODS and response.status_int < 400:
+            router.wrote(response)
+        return response
+
+    return replica_tween
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.replicas = Router(
+        settings.get('replicas.engines', ()),
+        sticky_seconds=int(
+            settings.get('replicas.sticky_seconds', STICKY_SECONDS))
+    )
+    # outside the transaction, so the whole of it uses one database, but
+    # inside the page cache, so cache hits don't count as reads
+    config.add_tween(
+        'replicas.tween_factory', over='pyramid_tm.tm_tween_factory',
+        under=('pagecache.tween_factory', EXCVIEW)
+    )
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""Every version of every entry, stored as compressed deltas
+
+Each edit adds a row to `entry_revisions` for the entry's new version.
+Most rows hold only a line diff against the version before, as JSON
+ops (a [start, end] pair copies those lines of the previous version, a
+string is new text), zlib compressed. Every SNAPSHOT_EVERY versions, and
+for the oldest version kept, a row holds the whole text instead, so
+rebuilding any version reads one snapshot and at most SNAPSHOT_EVERY - 1
+deltas after it, however long the history gets.
+
+Entries written before an edit have no revisions yet: their first edit
+stores the version it started from as a snapshot, then the edit.
+
+    GET /revisions?id=              the versions of an entry
+    GET /revision?id=&version=      one of them, rendered
+"""
+from __future__ import unicode_literals
+import datetime
+import difflib
+import json
+import zlib
+from collections import namedtuple
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPFound, HTTPNotFound
+import sqlalchemy as sa
+
+import journal
+
+
+SNAPSHOT_EVERY = 16
+LEVEL = 9
+
+# an edit, made to the entry `entry_id` to take it to `version`
+Change = namedtuple(
+    'Change', 'entry_id version old_title old_content title content')
+Revision = namedtuple('Revision', 'version title created snapshot size')
+
+
+class MissingRevision(LookupError):
+    """The revisions needed to rebuild a version aren't stored"""
+
+
+def diff(old, new):
+    """Line ops that turn `old` into `new`; see patch()"""
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines,
+                                      autojunk=False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(new_lines[j1:j2]))
+    return ops
+
+
+def patch(old, ops):
+    """Apply diff()'s ops to `old`"""
+    old_lines = old.splitlines(True)
+    parts = []
+    for op in ops:
+        if isinstance(op, list):
+            parts.extend(old_lines[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return ''.join(parts)
+
+
+def pack_text(text):
+    return zlib.compress(text.encode('utf-8'), LEVEL)
+
+
+def pack_delta(old, new):
+    ops = json.dumps(diff(old, new), separators=(',', ':'))
+    return zlib.compress(ops.encode('utf-8'), LEVEL)
+
+
+def unpack(data):
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+def record(session, changes, now=None):
+    """Store a revision for each of `changes`
+
+    Goes in with the edits themselves, in the same transaction, as a
+    multi-row INSERT.
+    """
+    if not changes:
+        return
+    if now is None:
+        now = datetime.datetime.utcnow()
+    EntryRevision = journal.EntryRevision
+    ids = list(set(change.entry_id for change in changes))
+    # the newest revision, and the newest snapshot, of each entry
+    latest = dict(
+        (row[0], (row[1], row[2])) for row in session.query(
+            EntryRevision.entry_id, sa.func.max(EntryRevision.number),
+            sa.func.max(sa.case(
+                [(EntryRevision.snapshot, EntryRevision.number)]))
+        ).filter(
+            EntryRevision.entry_id.in_(ids)
+        ).group_by(EntryRevision.entry_id)
+    )
+    rows = []
+    for change in changes:
+        # entries may have no content at all; store that as no text
+        old_content = change.old_content or ''
+        new_content = change.content or ''
+        newest, snapshot = latest.get(change.entry_id, (None, None))
+        base = change.version - 1
+        if newest != base:
+            # nothing stored for the version edited, so keep it whole
+            rows.append({
+                'entry_id': change.entry_id, 'number': base,
+                'snapshot': True, 'title': change.old_title,
+                'created': now, 'data': pack_text(old_content),
+            })
+            snapshot = base
+        whole = change.version - snapshot >= SNAPSHOT_EVERY
+        rows.append({
+            'entry_id': change.entry_id, 'number': change.version,
+            'snapshot': whole, 'title': change.title, 'created': now,
+            'data': pack_text(new_content) if whole else
+            pack_delta(old_content, new_content),
+        })
+        latest[change.entry_id] = (
+            change.version, change.version if whole else snapshot)
+    session.execute(EntryRevision.__table__.insert(), rows)
+
+
+def content(session, entry_id, number):
+    """The text of version `number` of an entry
+
+    Raises MissingRevision if it can't be rebuilt.
+    """
+    EntryRevision = journal.EntryRevision
+    start = session.query(sa.func.max(EntryRevision.number)).filter(
+        EntryRevision.entry_id == entry_id, EntryRevision.snapshot,
+        EntryRevision.number <= number
+    ).scalar()
+    if start is None:
+        raise MissingRevision(entry_id, number)
+    rows = session.query(
+        EntryRevision.number, EntryRevision.snapshot, EntryRevision.data
+    ).filter(
+        EntryRevision.entry_id == entry_id, EntryRevision.number >= start,
+        EntryRevision.number <= number
+    ).order_by(EntryRevision.number).all()
+    if [row.number for row in rows] != list(range(start, number + 1)):
+        raise MissingRevision(entry_id, number)
+    text = None
+    for row in rows:
+        if row.snapshot:
+            text = unpack(row.data)
+        else:
+            text = patch(text, json.loads(unpack(row.data)))
+    return text
+
+
+def history(session, entry_id):
+    """The stored versions of an entry, newest first, as Revisions"""
+    EntryRevision = journal.EntryRevision
+    rows = session.query(
+        EntryRevision.number, EntryRevision.title, EntryRevision.created,
+        EntryRevision.snapshot, sa.func.length(EntryRevision.data)
+    ).filter(
+        EntryRevision.entry_id == entry_id
+    ).order_by(EntryRevision.number.desc())
+    return [Revision(*row) for row in rows]
+
+
+def get_entry(request):
+    try:
+        entry_id = int(request.params.get('id', ''))
+    except ValueError:
+        raise HTTPBadRequest('invalid id')
+    entry = journal.DBSession.query(journal.Entry).get(entry_id)
+    if entry is None:
+        raise HTTPNotFound()
+    return entry
+
+
+def revisions_view(request):
+    if not request.authenticated_userid:
+        return HTTPFound(request.route_url('login'))
+    entry = get_entry(request)
+    return {
+        'entry': entry,
+        'revisions': history(journal.DBSession, entry.id),
+    }
+
+
+def revision_view(request):
+    if not request.authenticated_userid:
+        return HTTPFound(request.route_url('login'))
+    entry = get_entry(request)
+    try:
+        number = int(request.params.get('version', ''))
+    except ValueError:
+        raise HTTPBadRequest('invalid version')
+    EntryRevision = journal.EntryRevision
+    revision = journal.DBSession.query(EntryRevision).filter(
+        EntryRevision.entry_id == entry.id, EntryRevision.number == number
+    ).first()
+    if revision is None:
+        raise HTTPNotFound()
+    try:
+        text = content(journal.DBSession, entry.id, number)
+    except MissingRevision:
+        raise HTTPNotFound()
+    return {
+        'entry': entry,
+        'revision': revision,
+        'content_md': journal.render_markdown(text),
+    }
+
+
+def includeme(config):
+    config.add_route('revisions', '/revisions')
+    config.add_route('revision', '/revision')
+    config.add_view(
+        revisions_view, route_name='revisions',
+        renderer='journal:templates/revisions.jinja2'
+    )
+    config.add_view(
+        revision_view, route_name='revision',
+        renderer='journal:templates/revision.jinja2'
+    )
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Ranked full-text search over entry titles and content
+
+On PostgreSQL entries carry a `search_vector` tsvector column, kept up to
+date by a trigger and indexed with GIN. On SQLite an external-content
+FTS5 table, `entries_fts`, is kept in step with `entries` by triggers.
+Either way the database maintains the index itself, so bulk loads that
+bypass the ORM are searchable too.
+"""
+from __future__ import unicode_literals
+import re
+from collections import namedtuple
+
+import sqlalchemy as sa
+from markupsafe import Markup, escape
+
+
+# snippet highlight markers; private use characters that won't turn up in
+# entries and don't need escaping, swapped for <mark> after escaping
+START, STOP = '\ue000', '\ue001'
+
+Hit = namedtuple('Hit', 'id title date snippet score')
+
+WEIGHTED_VECTOR = (
+    "setweight(to_tsvector('english', coalesce({0}.title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({0}.content, '')), 'B')"
+)
+
+INSTALL = {
+    'postgresql': [
+        'ALTER TABLE entries ADD COLUMN IF NOT EXISTS search_vector tsvector',
+        'CREATE INDEX IF NOT EXISTS ix_entries_search '
+        'ON entries USING gin(search_vector)',
+        'CREATE OR REPLACE FUNCTION entries_search_update() '
+        'RETURNS trigger AS $$ BEGIN '
+        'NEW.search_vector := ' + WEIGHTED_VECTOR.format('NEW') + '; '
+        'RETURN NEW; END $$ LANGUAGE plpgsql',
+        'DROP TRIGGER IF EXISTS entries_search_update ON entries',
+        'CREATE TRIGGER entries_search_update '
+        'BEFORE INSERT OR UPDATE OF title, content ON entries '
+        'FOR EACH ROW EXECUTE PROCEDURE entries_search_update()',
+    ],
+    'sqlite': [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5('
+        "title, content, content='entries', content_rowid='id')",
+        'CREATE TRIGGER IF NOT EXISTS entries_fts_insert '
+        'AFTER INSERT ON entries BEGIN '
+        'INSERT INTO entries_fts(rowid, title, content) '
+        'VALUES (new.id, new.title, new.content); END',
+        'CREATE TRIGGER IF NOT EXISTS entries_fts_delete '
+        'AFTER DELETE ON entries BEGIN '
+        'INSERT INTO entries_fts(entries_fts, rowid, title, content) '
+        "VALUES ('delete', old.id, old.title, old.content); END",
+        'CREATE TRIGGER IF NOT EXISTS entries_fts_update '
+        'AFTER UPDATE OF title, content ON entries BEGIN '
+        'INSERT INTO entries_fts(entries_fts, rowid, title, content) '
+        "VALUES ('delete', old.id, old.title, old.content); "
+        'INSERT INTO entries_fts(rowid, title, content) '
+        'VALUES (new.id, new.title, new.content); END',
+        # rank by bm25 with title matches counting ten times as much
+        'INSERT INTO entries_fts(entries_fts, rank) '
+        "VALUES ('rank', 'bm25(10.0, 1.0)')",
+    ],
+}
+
+REBUILD = {
+    'postgresql': [
+        'UPDATE entries SET search_vector = ' +
+        WEIGHTED_VECTOR.format('entries'),
+    ],
+    'sqlite': [
+        "INSERT INTO entries_fts(entries_fts) VALUES ('rebuild')",
+    ],
+}
+
+UNINSTALL = {
+    'postgresql': [],
+    'sqlite': ['DROP TABLE IF EXISTS entries_fts'],
+}
+
+# one page of hits, best first, or with `backward` worst first, from
+# just after (or before) a cursor if there is one. Both rank by a score
+# that is lower for better matches, with newer entries first among equals
+QUERIES = {
+    'postgresql': (
+        'SELECT hits.id, hits.title, hits.date, hits.score, '
+        "ts_headline('english', hits.content, query, "
+        "'StartSel=' || :start || ', StopSel=' || :stop || "
+        "', MaxWords=35, MinWords=15') AS snippet "
+        'FROM (SELECT * FROM (SELECT id, title, date, content, query, '
+        '-ts_rank_cd(search_vector, query) AS score '
+        "FROM entries, plainto_tsquery('english', :terms) AS query "
+        'WHERE search_vector @@ query) AS ranked{where} '
+        'ORDER BY score {order}, id {id_order} LIMIT :limit) AS hits '
+        'ORDER BY hits.score {order}, hits.id {id_order}'
+    ),
+    # snippets only for the page's rows, looked up by rowid: made in the
+    # ranking subquery, or joined in any other order, they're made for
+    # every match, which is seconds when most entries match
+    'sqlite': (
+        'SELECT entries.id, entries.title, entries.date, hits.score, '
+        "snippet(entries_fts, 1, :start, :stop, '…', 24) AS snippet "
+        'FROM (SELECT rowid, rank AS score FROM entries_fts '
+        'WHERE entries_fts MATCH :terms{where} '
+        'ORDER BY rank {order}, rowid {id_order} LIMIT :limit) AS hits '
+        'CROSS JOIN entries_fts CROSS JOIN entries '
+        'WHERE entries_fts MATCH :terms AND entries_fts.rowid = hits.rowid '
+        'AND entries.id = hits.rowid '
+        'ORDER BY hits.score {order}, hits.rowid {id_order}'
+    ),
+}
+
+CURSOR_WHERE = {
+    'postgresql': ' WHERE (score {cmp} :score OR '
+                  '(score = :score AND id {id_cmp} :id))',
+    'sqlite': ' AND (rank {cmp} :score OR '
+              '(rank = :score AND rowid {id_cmp} :id))',
+}
+
+
+def encode_cursor(hit):
+    """Make an opaque results position out of a hit's (score, id)"""
+    # repr, so that the score comes back as exactly the same float
+    return '{!r}_{}'.format(hit.score, hit.id)
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (score, id), raising ValueError if mangled"""
+    score, _, hit_id = cursor.partition('_')
+    return float(score), int(hit_id)
+
+
+def query_for(dialect, cursor=False, backward=False):
+    if backward:
+        order, id_order, cmp, id_cmp = 'DESC', 'ASC', '<', '>'
+    else:
+        order, id_order, cmp, id_cmp = 'ASC', 'DESC', '>', '<'
+    where = ''
+    if cursor:
+        where = CURSOR_WHERE[dialect].format(cmp=cmp, id_cmp=id_cmp)
+    query = sa.text(QUERIES[dialect].format(
+        where=where, order=order, id_order=id_order))
+    return query.columns(date=sa.DateTime)
+
+
+def execute_all(conn, statements):
+    for statement in statements.get(conn.dialect.name, []):
+        conn.execute(sa.text(statement))
+
+
+def install(conn):
+    """Set up the search index and its triggers, then fill it"""
+    execute_all(conn, INSTALL)
+    execute_all(conn, REBUILD)
+
+
+def on_create(target, conn, **kw):
+    execute_all(conn, INSTALL)
+
+
+def on_drop(target, conn, **kw):
+    execute_all(conn, UNINSTALL)
+
+
+def listen(table):
+    """Have create_all/drop_all set up and tear down the search index"""
+    sa.event.listen(table, 'after_create', on_create)
+    sa.event.listen(table, 'before_drop', on_drop)
+
+
+def terms_for(dialect, query):
+    """Turn what the user typed into something safe to hand the database"""
+    words = re.findall(r'\w+', query, re.UNICODE)
+    if dialect != 'sqlite':
+        return ' '.join(words)
+    # FTS5 has its own query syntax; quote every word so nothing in the
+    # input is taken as an operator
+    return ' '.join('"{}"'.format(word) for word in words)
+
+
+def highlight(snippet):
+    """Escape a snippet and mark up the matched words"""
+    if snippet is None:
+        return Markup('')
+    return escape(snippet).replace(
+        START, Markup('<mark>')
+    ).replace(STOP, Markup('</mark>'))
+
+
+def search(session, query, limit, after=None, before=None):
+    """The best matches for `query` as Hit(id, title, date, snippet, score)s
+
+    `after` and `before` are cursors from earlier results: the hits are
+    the next `limit` after the one `after`, or the `limit` up to the one
+    `before`, best first either way. The snippet is safe HTML with the
+    matches wrapped in <mark>.
+    """
+    dialect = session.get_bind().dialect.name
+    terms = terms_for(dialect, query)
+    if not terms:
+        return []
+    params = {'terms': terms, 'start': START, 'stop': STOP, 'limit': limit}
+    cursor = after if after is not None else before
+    if cursor is not None:
+        params['score'], params['id'] = decode_cursor(cursor)
+    rows = session.execute(query_for(
+        dialect, cursor=cursor is not None, backward=before is not None
+    ), params).fetchall()
+    if before is not None:
+        rows.reverse()
+    return [
+        Hit(row.id, row.title, row.date, highlight(row.snippet), row.score)
+        for row in rows
+    ]
+
+
+def page(session, query, limit, after=None, before=None):
+    """One page of results, by keyset pagination like Entry.page
+
+    Returns (hits, better, more) where better and more are the cursors
+    for the pages of better and of further matches, or None at either end.
+    """
+    hits = search(session, query, limit + 1, after=after, before=before)
+    extra = len(hits) > limit
+    if before is not None:
+        hits = hits[len(hits) - limit:] if extra else hits
+        has_better, has_more = extra, True
+    else:
+        hits = hits[:limit]
+        has_better, has_more = after is not None, extra
+    if not hits:
+        return hits, None, None
+    better = encode_cursor(hits[0]) if has_better else None
+    more = encode_cursor(hits[-1]) if has_more else None
+    return hits, better, more
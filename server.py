@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Serve the journal in production
+
+    python server.py
+
+runs the app under waitress, configured from the environment:
+
+    PORT                    port to listen on (default 5000)
+    WEB_CONCURRENCY         worker processes (default 1)
+    WEB_THREADS             request threads per process (default 4)
+    WEB_CONNECTION_LIMIT    open connections per process (default 100)
+    WEB_BACKLOG             connections the kernel queues (default 128)
+    WEB_MAX_QUEUE           requests per process waiting for a thread
+                            (default 16)
+    WEB_CHANNEL_TIMEOUT     seconds before an idle connection is closed
+                            (default 30)
+    WEB_GRACEFUL_TIMEOUT    seconds to finish requests on shutdown
+                            (default 30)
+
+With more than one worker, the parent process opens the listening socket
+and forks the workers, which all accept connections from it, and starts
+a new worker if one dies. Each worker builds its own app after the fork,
+so no database connections are shared between processes. The workers
+share one page cache, a SQLite file in a temporary directory, unless
+PAGE_CACHE names another shared one (or is off): with a cache in each
+worker's memory, a write would only evict the pages of the worker that
+handled it.
+
+A request that arrives when every thread is busy and WEB_MAX_QUEUE
+requests are already waiting is answered at once with 503 and
+Retry-After, instead of queueing until it times out. Past
+WEB_CONNECTION_LIMIT, a worker stops accepting and new connections wait
+in the kernel's backlog, where another worker may pick them up.
+
+Each worker also runs background jobs on JOB_THREADS threads (see
+jobs.py).
+
+On SIGTERM (or SIGINT) a worker stops accepting connections, finishes the
+requests it has, up to WEB_GRACEFUL_TIMEOUT, and the jobs it's running,
+and exits; the parent passes the signal on to its workers and waits for
+them.
+"""
+from __future__ import unicode_literals
+import asyncore
+import errno
+import logging
+import os
+import signal
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from waitress.adjustments import Adjustments
+from waitress.server import TcpWSGIServer
+from waitress.task import Task, ThreadedTaskDispatcher
+
+import metrics
+
+
+log = logging.getLogger('journal.server')
+
+DEFAULTS = {
+    'PORT': 5000,
+    'WEB_CONCURRENCY': 1,
+    'WEB_THREADS': 4,
+    'WEB_CONNECTION_LIMIT': 100,
+    'WEB_BACKLOG': 128,
+    'WEB_MAX_QUEUE': 16,
+    'WEB_CHANNEL_TIMEOUT': 30,
+    'WEB_GRACEFUL_TIMEOUT': 30,
+}
+SHED_BODY = b'Server busy, try again in a moment\n'
+
+
+def settings_from_environ(environ):
+    """The server's settings, from environment variables or the defaults"""
+    settings = dict(
+        (name, int(environ.get(name, default)))
+        for name, default in DEFAULTS.items()
+    )
+    settings['HOST'] = environ.get('HOST', '0.0.0.0')
+    return settings
+
+
+class ShedTask(Task):
+    """Answers a request with 503 without running the app"""
+    complete = True
+
+    def execute(self):
+        self.status = '503 Service Unavailable'
+        self.content_length = len(SHED_BODY)
+        self.response_headers.extend([
+            ('Content-Length', str(len(SHED_BODY))),
+            ('Content-Type', 'text/plain'),
+            ('Retry-After', '1'),
+            ('Connection', 'close'),
+        ])
+        self.close_on_finish = True
+        self.write(SHED_BODY)
+
+
+class Job(object):
+    """A connection's turn on a request thread, counted until it's done"""
+
+    def __init__(self, channel, done):
+        self.channel = channel
+        self.done = done
+
+    def defer(self):
+        self.channel.defer()
+
+    def service(self):
+        try:
+            self.channel.service()
+        finally:
+            self.done()
+
+    def cancel(self):
+        try:
+            self.channel.cancel()
+        finally:
+            self.done()
+
+
+class SheddingDispatcher(ThreadedTaskDispatcher):
+    """Waitress' thread pool, with a bound on how many requests may wait
+
+    Waitress queues requests for its threads without limit. Here, once
+    every thread is busy and `max_queue` more are waiting, further
+    requests are answered with 503 straight away, from the server's own
+    thread.
+    """
+
+    def __init__(self, threads, max_queue):
+        super(SheddingDispatcher, self).__init__()
+        self.limit = threads + max_queue
+        self.pending = 0
+        self._lock = threading.Lock()
+        self.set_thread_count(threads)
+
+    def finished(self):
+        with self._lock:
+            self.pending -= 1
+
+    def add_task(self, channel):
+        with self._lock:
+            full = self.pending >= self.limit
+            if not full:
+                self.pending += 1
+        if full:
+            metrics.SHED.inc()
+            channel.task_class = ShedTask
+            channel.service()
+            return
+        super(SheddingDispatcher, self).add_task(Job(channel, self.finished))
+
+
+class SharedSocketServer(TcpWSGIServer):
+    """A waitress server on a socket some other process has bound"""
+
+    def bind_server_socket(self):
+        pass
+
+
+def make_server(app, settings, sock=None):
+    adj = Adjustments(
+        host=settings['HOST'],
+        port=settings['PORT'],
+        threads=settings['WEB_THREADS'],
+        connection_limit=settings['WEB_CONNECTION_LIMIT'],
+        backlog=settings['WEB_BACKLOG'],
+        channel_timeout=settings['WEB_CHANNEL_TIMEOUT'],
+    )
+    dispatcher = SheddingDispatcher(
+        settings['WEB_THREADS'], settings['WEB_MAX_QUEUE'])
+    cls = TcpWSGIServer if sock is None else SharedSocketServer
+    return cls(app, _sock=sock, _dispatcher=dispatcher, adj=adj)
+
+
+def is_idle(server):
+    """True once no request is running, waiting or still being sent"""
+    if server.task_dispatcher.pending:
+        return False
+    return not any(
+        channel.requests or channel.any_outbuf_has_data()
+        for channel in list(server.active_channels.values())
+    )
+
+
+def serve_until_stopped(server, graceful_timeout, stopping=None):
+    """Run `server` until a stop signal, then drain it and return
+
+    `stopping` is a list that something else, a signal handler or a test,
+    appends the time to when the server should stop.
+    """
+    if stopping is None:
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(time.time())
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+    while True:
+        asyncore.loop(
+            timeout=1, map=server._map, count=1,
+            use_poll=server.adj.asyncore_use_poll
+        )
+        if not stopping:
+            continue
+        if server.accepting:
+            server.accepting = False
+            server.del_channel()
+        if is_idle(server) or time.time() > stopping[0] + graceful_timeout:
+            break
+    for channel in list(server.active_channels.values()):
+        channel.close()
+    server.task_dispatcher.shutdown(timeout=1)
+
+
+def run_worker(settings, sock=None):
+    # only now, after any fork: the app opens database connections
+    import journal
+    app = journal.main()
+    server = make_server(app, settings, sock)
+    log.info('worker %s serving on http://%s:%s', os.getpid(),
+             server.effective_host, server.effective_port)
+    app.registry.job_runner.start()
+    serve_until_stopped(server, settings['WEB_GRACEFUL_TIMEOUT'])
+    app.registry.job_runner.stop()
+    log.info('worker %s stopped', os.getpid())
+
+
+def listen(settings):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((settings['HOST'], settings['PORT']))
+    sock.listen(settings['WEB_BACKLOG'])
+    return sock
+
+
+def share_page_cache(environ):
+    """Have every worker use one page cache; returns a directory to remove
+
+    Only PAGE_CACHE=off or a shared backend is left as it is.
+    """
+    backend = environ.get('PAGE_CACHE', 'memory')
+    if backend != 'memory':
+        return None
+    if 'PAGE_CACHE' in environ:
+        log.warning('PAGE_CACHE=memory would give each worker a cache of '
+                    'its own; using a shared one')
+    directory = tempfile.mkdtemp(prefix='journal-pages-')
+    environ['PAGE_CACHE'] = 'sqlite:{}'.format(
+        os.path.join(directory, 'pages.db'))
+    return directory
+
+
+def prefork(settings):
+    """Fork the workers on a shared socket and look after them"""
+    cache_dir = share_page_cache(os.environ)
+    sock = listen(settings)
+    children = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(settings, sock)
+            except Exception:
+                log.exception('worker %s failed', os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.time()
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for number in range(settings['WEB_CONCURRENCY']):
+        spawn()
+    signalled = False
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise
+            pid = None
+        if stopping and not signalled:
+            signalled = True
+            for child in children:
+                os.kill(child, signal.SIGTERM)
+        if pid is None or pid not in children:
+            continue
+        started = children.pop(pid)
+        if not stopping:
+            log.warning('worker %s exited (status %s), starting another',
+                        pid, status)
+            if time.time() - started < 1:
+                # don't spin if workers die as soon as they start
+                time.sleep(1)
+            spawn()
+    sock.close()
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    settings = settings_from_environ(os.environ)
+    if settings['WEB_CONCURRENCY'] > 1:
+        prefork(settings)
+    else:
+        run_worker(settings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Export the journal as a static site
+
+    python manage.py site public/
+
+renders the listing, every entry's page and the assets into a directory
+that any static file server can serve at the root of a site:
+
+    index.html, page/2.html, ...   the listing, a page at a time
+    detail/<id>.html               each entry, with its stored HTML
+    assets/                        the fingerprinted stylesheets
+
+Pages come from the same templates as the live site, rendered with
+`static_site` set so that links point at the exported files and search
+and login, which need the app, are left out.
+
+Exports are incremental. A manifest in the output directory records a
+fingerprint of every exported entry (its title, date and version), and
+only entries whose fingerprint changed are rendered again; entries that
+have been deleted have their pages removed. A change to the templates,
+the assets or the renderer version starts the export over. Entry pages
+are rendered by a pool of worker processes when there are enough of them
+to be worth it.
+"""
+from __future__ import unicode_literals
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+
+from pyramid.renderers import render
+from pyramid.request import Request
+import transaction
+
+import journal
+
+
+MANIFEST = '.sitegen.json'
+CHUNK_SIZE = 200
+
+
+def detail_path(entry_id):
+    return 'detail/{}.html'.format(entry_id)
+
+
+def page_path(number):
+    return 'index.html' if number == 1 else 'page/{}.html'.format(number)
+
+
+def page_url(number):
+    return '/' if number == 1 else '/' + page_path(number)
+
+
+def static_request(registry, **methods):
+    """A request to render templates with, outside of any real request"""
+    request = Request.blank('/')
+    request.registry = registry
+    request.detail_url = lambda entry_id: '/' + detail_path(entry_id)
+    for name, method in methods.items():
+        setattr(request, name, method)
+    return request
+
+
+def render_page(registry, template, values, **methods):
+    values = dict(values, static_site=True)
+    return render(
+        template, values, request=static_request(registry, **methods),
+        package=journal
+    )
+
+
+def write_page(out, path, html, only_if_changed=False):
+    """Write a page; returns False if it was already there, unchanged"""
+    data = html.encode('utf-8')
+    target = os.path.join(out, *path.split('/'))
+    if only_if_changed and os.path.exists(target):
+        with io.open(target, 'rb') as existing:
+            if existing.read() == data:
+                return False
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with io.open(target + '.tmp', 'wb') as page:
+        page.write(data)
+    os.rename(target + '.tmp', target)
+    return True
+
+
+def remove_page(out, path):
+    target = os.path.join(out, *path.split('/'))
+    if os.path.exists(target):
+        os.remove(target)
+
+
+def site_fingerprint(registry):
+    """Changes whenever every page has to be rendered again"""
+    digest = hashlib.sha1()
+    for filename in sorted(os.listdir(journal.TEMPLATE_DIR)):
+        path = os.path.join(journal.TEMPLATE_DIR, filename)
+        with io.open(path, 'rb') as template:
+            digest.update(template.read())
+    digest.update(json.dumps(
+        registry.assets.manifest, sort_keys=True).encode('utf-8'))
+    digest.update('{}'.format(journal.RENDERER_VERSION).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def entry_fingerprints(session):
+    """{entry id: fingerprint} for every entry, without loading content
+
+    Every edit bumps the version, whether or not its HTML has been
+    rendered yet, so that's what the fingerprint goes by.
+    """
+    Entry = journal.Entry
+    rows = session.query(
+        Entry.id, Entry.title, Entry.date, Entry.version, Entry.updated_at
+    ).yield_per(1000)
+    return dict(
+        ('{}'.format(row.id), journal.make_etag(
+            row.title, row.date, row.version, row.updated_at))
+        for row in rows
+    )
+
+
+def render_entries(registry, session, entry_ids, out):
+    """Write the pages of some entries; returns how many were written"""
+    Entry = journal.Entry
+    entries = session.query(Entry).filter(Entry.id.in_(entry_ids))
+    count = 0
+    for entry in entries:
+        html = render_page(
+            registry, 'templates/detail.jinja2', {'entry': entry})
+        write_page(out, detail_path(entry.id), html)
+        count += 1
+    return count
+
+
+def render_listing(registry, session, out, page_size):
+    """Write every listing page, skipping unchanged ones
+
+    Returns (pages, pages written).
+    """
+    number = 0
+    written = 0
+    before = None
+    while True:
+        number += 1
+        entries, newer, older = journal.Entry.page(
+            before=before, limit=page_size, session=session)
+        # the page after (older than) this one is number + 1, and the one
+        # before it number - 1, whatever cursors the template passes
+        this_page = number
+        html = render_page(
+            registry, 'templates/index.jinja2',
+            {'entries': entries, 'newer': newer, 'older': older},
+            listing_url=lambda before=None, after=None: page_url(
+                this_page + 1 if before is not None else this_page - 1)
+        )
+        if write_page(out, page_path(number), html, only_if_changed=True):
+            written += 1
+        if older is None:
+            return number, written
+        before = older
+
+
+def copy_assets(registry, out):
+    """Copy the built assets (they never change in place) that are missing"""
+    source = registry.assets.target
+    target = os.path.join(out, 'assets')
+    count = 0
+    for root, dirs, files in os.walk(source):
+        for filename in files:
+            if filename == 'manifest.json' or filename.endswith('.tmp'):
+                continue
+            path = os.path.join(root, filename)
+            copy = os.path.join(target, os.path.relpath(path, source))
+            if not os.path.exists(copy):
+                if not os.path.isdir(os.path.dirname(copy)):
+                    os.makedirs(os.path.dirname(copy))
+                shutil.copyfile(path, copy)
+                count += 1
+    return count
+
+
+def load_manifest(out):
+    path = os.path.join(out, MANIFEST)
+    if os.path.exists(path):
+        with io.open(path, encoding='utf-8') as manifest:
+            return json.load(manifest)
+    return {}
+
+
+def save_manifest(out, manifest):
+    path = os.path.join(out, MANIFEST)
+    with io.open(path + '.tmp', 'w', encoding='utf-8') as saved:
+        saved.write('{}'.format(json.dumps(manifest, sort_keys=True)))
+    os.rename(path + '.tmp', path)
+
+
+_worker = {}
+
+
+def init_worker():
+    # connections inherited from the parent can't be shared with it
+    journal.engine.dispose()
+    journal.DBSession.remove()
+    journal.DBSession.configure(bind=journal.engine)
+    _worker['registry'] = journal.main().registry
+
+
+def render_chunk(job):
+    out, entry_ids = job
+    with transaction.manager:
+        count = render_entries(
+            _worker['registry'], journal.DBSession, entry_ids, out)
+    return entry_ids, count
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def export(registry, session, out, processes=None, chunk_size=CHUNK_SIZE,
+           full=False, log=None):
+    """Bring the static site in `out` up to date with the database
+
+    Returns a dict of what was done.
+    """
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    manifest = load_manifest(out)
+    site = site_fingerprint(registry)
+    if full or manifest.get('site') != site:
+        manifest = {'site': site, 'entries': {}}
+    done = manifest['entries']
+    current = entry_fingerprints(session)
+    changed = sorted(
+        (int(entry_id) for entry_id, fingerprint in current.items()
+         if done.get(entry_id) != fingerprint)
+    )
+    removed = [entry_id for entry_id in done if entry_id not in current]
+    for entry_id in removed:
+        remove_page(out, detail_path(entry_id))
+        del done[entry_id]
+
+    rendered = [0]
+
+    def finished(entry_ids):
+        for entry_id in entry_ids:
+            key = '{}'.format(entry_id)
+            done[key] = current[key]
+        save_manifest(out, manifest)
+        rendered[0] += len(entry_ids)
+        if log is not None:
+            log('{} of {} changed entries rendered'.format(
+                rendered[0], len(changed)))
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    jobs = list(chunks(changed, chunk_size))
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(
+            min(processes, len(jobs)), initializer=init_worker)
+        try:
+            for entry_ids, count in pool.imap_unordered(
+                render_chunk, [(out, ids) for ids in jobs]
+            ):
+                finished(entry_ids)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for entry_ids in jobs:
+            render_entries(registry, session, entry_ids, out)
+            finished(entry_ids)
+
+    page_size = int(registry.settings.get(
+        'journal.page_size', journal.PAGE_SIZE))
+    pages, pages_written = render_listing(registry, session, out, page_size)
+    number = pages + 1
+    while os.path.exists(os.path.join(out, *page_path(number).split('/'))):
+        remove_page(out, page_path(number))
+        number += 1
+    assets = copy_assets(registry, out)
+    save_manifest(out, manifest)
+    return {
+        'entries': len(changed), 'removed': len(removed),
+        'pages': pages, 'pages_written': pages_written, 'assets': assets,
+    }
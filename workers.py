@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""A small bounded thread pool
+
+Work that is slow or CPU heavy is handed to one of these so that it can't
+tie up all of waitress's request threads at once. The queue in front of
+the pool is bounded: when it's full `submit` raises `Full` straight away
+and the caller can turn the request down instead of making it wait.
+"""
+from __future__ import unicode_literals
+import sys
+import threading
+
+try:
+    from Queue import Queue, Full
+except ImportError:  # pragma: no cover
+    from queue import Queue, Full
+
+
+class Timeout(RuntimeError):
+    """A Future's result didn't come in time"""
+
+
+class Future(object):
+    """The eventual result of a call handed to a ThreadPool"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call and return its result or raise its exception
+
+        Raises Timeout if `timeout` seconds pass first.
+        """
+        if not self._done.wait(timeout):
+            raise Timeout('timed out waiting for worker')
+        if self._exc_info is not None:
+            exc_type, exc, tb = self._exc_info
+            raise exc
+        return self._result
+
+    def _run(self, func, args, kw):
+        try:
+            self._result = func(*args, **kw)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+
+class ThreadPool(object):
+    """A fixed number of daemon threads working off a bounded queue"""
+
+    def __init__(self, size, max_queue, name='worker'):
+        if max_queue < 1:
+            raise ValueError('max_queue must be at least 1')
+        self.size = size
+        self.name = name
+        self._queue = Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(
+                    target=self._work,
+                    name='{}-{}'.format(self.name, len(self._threads))
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kw = item
+            future._run(func, args, kw)
+
+    def submit(self, func, *args, **kw):
+        """Queue up func(*args, **kw); raise Full if the queue is full"""
+        if len(self._threads) < self.size:
+            self._start()
+        future = Future()
+        self._queue.put_nowait((future, func, args, kw))
+        return future
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def shutdown(self):
+        """Let queued work finish, then stop the threads"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()